@@ -0,0 +1,459 @@
+#!/usr/bin/env python
+
+"""
+Benchmarks docbuilder and validate_report using synthetic PenText projects.
+
+Copyright (C) 2015-2016 Peter Mosmans [Radically Open Security]
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+
+import argparse
+import contextlib
+import json
+import os
+import random
+import shutil
+import stat
+import sys
+import tempfile
+import textwrap
+import time
+
+import docbuilder
+
+try:
+    import validate_report
+except ImportError as exception:
+    validate_report = None
+    print('[-] validate_report not available ({0}): validation benchmarks '
+          'disabled'.format(exception))
+
+
+WORDS = ['application', 'attacker', 'authentication', 'browser', 'cookie',
+         'credentials', 'database', 'encryption', 'header', 'injection',
+         'input', 'password', 'request', 'response', 'server', 'session',
+         'the', 'a', 'of', 'and', 'to', 'is', 'can', 'be', 'by', 'user']
+# A 1x1 transparent PNG image
+PNG = (b'\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR\x00\x00\x00\x01\x00\x00\x00\x01'
+       b'\x08\x06\x00\x00\x00\x1f\x15\xc4\x89\x00\x00\x00\rIDATx\x9cc\xf8\x0f'
+       b'\x00\x00\x01\x01\x00\x05\x18\xd8N\x00\x00\x00\x00IEND\xaeB`\x82')
+# Stand-in for java -jar saxon.jar: concatenates the input and its XIncludes
+SAXON_STUB = r'''#!{python}
+import os, re, sys
+arguments = dict(arg[1:].split(':', 1) for arg in sys.argv if
+                 arg.startswith(('-s:', '-o:')))
+source = arguments['s']
+with open(source, 'rb') as xml_file:
+    contents = xml_file.read()
+for href in re.findall(b'href="([^"]+)"', contents):
+    with open(os.path.join(os.path.dirname(source),
+                           href.decode('utf-8')), 'rb') as included:
+        contents += included.read()
+contents = b'<fo:root>GITREV' + contents + b'</fo:root>'
+if 'o' in arguments:
+    with open(arguments['o'], 'wb') as fo_file:
+        fo_file.write(contents)
+else:
+    getattr(sys.stdout, 'buffer', sys.stdout).write(contents)
+'''
+# Stand-in for fop: writes the fo file as PDF file
+FOP_STUB = r'''#!{python}
+import sys
+arguments = sys.argv[1:]
+if '-fo' in arguments:
+    source = arguments[arguments.index('-fo') + 1]
+    output = arguments[arguments.index('-pdf') + 1]
+else:
+    source, output = arguments[2:4]
+if source == '-':
+    contents = getattr(sys.stdin, 'buffer', sys.stdin).read()
+else:
+    with open(source, 'rb') as fo_file:
+        contents = fo_file.read()
+with open(output, 'wb') as pdf_file:
+    pdf_file.write(b'%PDF-1.4\n' + contents)
+'''
+
+
+def parse_arguments():
+    """
+    Parses command line arguments.
+    """
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description=textwrap.dedent('''\
+Benchmarks docbuilder and validate_report using synthetic PenText projects.
+
+Copyright (C) 2015-2016 Peter Mosmans [Go Forward]
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.'''))
+    parser.add_argument('--compare', action='store',
+                        help='compare results with an earlier results file')
+    parser.add_argument('--findings', action='store', type=int, default=50,
+                        help='number of findings (default 50)')
+    parser.add_argument('--fop-binary', action='store',
+                        default='/usr/local/bin/fop',
+                        help="""fop binary, replaced by a stand-in when
+                        missing (default /usr/local/bin/fop)""")
+    parser.add_argument('--images', action='store', type=int, default=1,
+                        help='number of images per finding (default 1)')
+    parser.add_argument('--keep', action='store_true',
+                        help='keep the generated project')
+    parser.add_argument('--non-findings', action='store', type=int,
+                        default=20,
+                        help='number of non-findings (default 20)')
+    parser.add_argument('-o', '--output', action='store',
+                        help='write results as JSON to OUTPUT')
+    parser.add_argument('--pre-lines', action='store', type=int, default=20,
+                        help='number of lines per <pre> block (default 20)')
+    parser.add_argument('--repeat', action='store', type=int, default=3,
+                        help='number of runs per benchmark (default 3)')
+    parser.add_argument('--saxon', action='store',
+                        default='/usr/local/bin/saxon/saxon9he.jar',
+                        help="""saxon JAR file, replaced by a stand-in when
+                        missing (default /usr/local/bin/saxon/saxon9he.jar)""")
+    parser.add_argument('--scans', action='store', type=int, default=5,
+                        help='number of scans (default 5)')
+    parser.add_argument('--scan-lines', action='store', type=int,
+                        default=1000,
+                        help='number of lines per scan (default 1000)')
+    parser.add_argument('--seed', action='store', type=int, default=1,
+                        help='seed for generating text (default 1)')
+    parser.add_argument('--text-size', action='store', type=int,
+                        default=2000,
+                        help="""number of characters of text per finding
+                        section (default 2000)""")
+    return vars(parser.parse_args())
+
+
+def text(generator, size):
+    """
+    Returns @size characters of random words.
+    """
+    words = []
+    length = 0
+    while length < size:
+        word = generator.choice(WORDS)
+        words.append(word)
+        length += len(word) + 1
+    return ' '.join(words).capitalize() + '.'
+
+
+def pre_block(generator, lines):
+    """
+    Returns @lines lines of command output of varying length.
+    """
+    return '\n'.join('{0:04d} '.format(line) +
+                     ' '.join(generator.choice(WORDS)
+                              for _ in range(generator.randint(2, 8)))
+                     for line in range(lines))
+
+
+def write_file(filename, contents):
+    """
+    Writes @contents to @filename, creating directories when necessary.
+    """
+    if not os.path.isdir(os.path.dirname(filename)):
+        os.makedirs(os.path.dirname(filename))
+    with open(filename, 'w') as output_file:
+        output_file.write(contents)
+
+
+def generate_project(root, options):
+    """
+    Generates a synthetic PenText project in @root.
+    Returns a list of all files, relative to @root.
+    """
+    generator = random.Random(options['seed'])
+    source = os.path.join(root, 'source')
+    includes = {'findings': [], 'nonFindings': [], 'scans': []}
+    for number in range(options['findings']):
+        images = ''.join('<img src="../graphics/finding{0}_{1}.png"/>'.
+                         format(number, image)
+                         for image in range(options['images']))
+        for image in range(options['images']):
+            filename = os.path.join(root, 'graphics',
+                                    'finding{0}_{1}.png'.format(number, image))
+            if not os.path.isdir(os.path.dirname(filename)):
+                os.makedirs(os.path.dirname(filename))
+            with open(filename, 'wb') as image_file:
+                image_file.write(PNG)
+        write_file(os.path.join(source, 'findings', 'f{0}.xml'.format(number)),
+                   '''<finding id="f{0}" threatLevel="{1}" type="Cross-Site Scripting">
+  <title>Finding Number {0}</title>
+  <description>{2}</description>
+  <technicaldescription>
+    <p>{3}</p>
+    <pre>{4}</pre>
+    {5}
+  </technicaldescription>
+  <impact>{2}</impact>
+  <recommendation>{3}</recommendation>
+</finding>
+'''.format(number, generator.choice(['Low', 'Moderate', 'Elevated', 'High',
+                                      'Extreme']),
+           text(generator, options['text_size'] // 4),
+           text(generator, options['text_size']),
+           pre_block(generator, options['pre_lines']), images))
+        includes['findings'].append('findings/f{0}.xml'.format(number))
+    for number in range(options['non_findings']):
+        write_file(os.path.join(source, 'non-findings',
+                                'nf{0}.xml'.format(number)),
+                   '''<non-finding id="nf{0}">
+  <title>Non Finding Number {0}</title>
+  <p>{1}</p>
+</non-finding>
+'''.format(number, text(generator, options['text_size'])))
+        includes['nonFindings'].append('non-findings/nf{0}.xml'.format(number))
+    for number in range(options['scans']):
+        write_file(os.path.join(source, 'scans', 's{0}.xml'.format(number)),
+                   '<scan id="s{0}">\n  <pre>{1}</pre>\n</scan>\n'.
+                   format(number, pre_block(generator,
+                                            options['scan_lines'])))
+        includes['scans'].append('scans/s{0}.xml'.format(number))
+    sections = ''.join('''  <section id="{0}">
+{1}
+  </section>
+'''.format(section, '\n'.join('    <xi:include href="{0}"/>'.format(href)
+                              for href in hrefs))
+                       for section, hrefs in sorted(includes.items()))
+    write_file(os.path.join(source, 'report.xml'),
+               '''<?xml version="1.0" encoding="utf-8"?>
+<pentest_report xmlns:xi="http://www.w3.org/2001/XInclude" findingCode="BEN">
+  <meta><title>Penetration Test Report</title></meta>
+{0}</pentest_report>
+'''.format(sections))
+    write_file(os.path.join(root, 'xslt', 'generate_report.xsl'),
+               '''<?xml version="1.0" encoding="utf-8"?>
+<xsl:stylesheet version="2.0"
+                xmlns:xsl="http://www.w3.org/1999/XSL/Transform">
+  <xsl:template match="/"><xsl:apply-templates/></xsl:template>
+</xsl:stylesheet>
+''')
+    write_file(os.path.join(source, 'offerte.xml'),
+               '''<?xml version="1.0" encoding="utf-8"?>
+<offerte>
+  <meta><title>Offer</title></meta>
+  <section id="scope"><p>{0}</p></section>
+</offerte>
+'''.format(text(generator, options['text_size'])))
+    files = []
+    for path, _dirs, filenames in os.walk(root):
+        files += [os.path.relpath(os.path.join(path, filename), root).
+                  replace(os.sep, '/') for filename in filenames]
+    return sorted(files)
+
+
+def write_stub(directory, name, contents):
+    """
+    Writes an executable stand-in script @name into @directory.
+    Returns the filename of the stand-in.
+    """
+    filename = os.path.join(directory, name)
+    with open(filename, 'w') as stub:
+        stub.write(contents.replace('{python}', sys.executable))
+    os.chmod(filename, os.stat(filename).st_mode | stat.S_IXUSR)
+    return filename
+
+
+@contextlib.contextmanager
+def arguments(argv):
+    """
+    Temporarily replaces the command line arguments by @argv.
+    """
+    original = sys.argv
+    sys.argv = [original[0]] + argv
+    try:
+        yield
+    finally:
+        sys.argv = original
+
+
+@contextlib.contextmanager
+def silenced():
+    """
+    Temporarily discards standard out.
+    """
+    original = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        yield
+    finally:
+        sys.stdout.close()
+        sys.stdout = original
+
+
+def measure(name, function, repeat, results):
+    """
+    Runs @function @repeat times, and stores the timings in @results.
+    """
+    timings = []
+    for _ in range(repeat):
+        reset_caches()
+        start = time.time()
+        with silenced():
+            function()
+        timings.append(time.time() - start)
+    timings.sort()
+    results[name] = {'min': timings[0], 'median': timings[len(timings) // 2],
+                     'runs': timings}
+    print('[*] {0:<28} min {1:8.4f}s  median {2:8.4f}s'.
+          format(name, timings[0], timings[len(timings) // 2]))
+    sys.stdout.flush()
+
+
+def reset_caches():
+    """
+    Empties the caches of validate_report, so that each run starts cold.
+    """
+    if validate_report:
+        validate_report.PARSED.clear()
+        validate_report.WORDS.clear()
+        validate_report.NEW_WORDS.clear()
+        validate_report.TEXTS.clear()
+        del validate_report.ISSUES[:]
+        validate_report.TIMINGS.clear()
+
+
+def benchmark_validation(files, options, results):
+    """
+    Benchmarks the validate_report checks on the project in the current
+    directory.
+    """
+    with arguments(['--all', '--no-cache']):
+        validate_options = validate_report.parse_arguments()
+    validate_options['all'] = True
+    validate_options['capitalization'] = True
+    validate_options['long'] = True
+    master = 'source/report.xml'
+    externals = [filename for filename in files
+                 if filename.startswith(('source/findings/',
+                                         'source/non-findings/',
+                                         'source/scans/'))]
+    measure('validate_files', lambda: validate_report.validate_files(
+        files, validate_options), options['repeat'], results)
+    measure('cross_check_files', lambda: validate_report.cross_check_files(
+        master, externals), options['repeat'], results)
+    trees = [(filename, validate_report.ElementTree.parse(filename))
+             for filename in externals]
+
+    def keywords():  # pylint: disable=missing-docstring
+        for filename, tree in trees:
+            validate_report.find_keywords(tree, filename, validate_options)
+
+    measure('find_keywords', keywords, options['repeat'], results)
+    if not hasattr(validate_report, 'aspell'):
+        print('[-] aspell not installed: skipping spelling benchmark')
+        return
+    validate_options['spelling'] = True
+
+    def spelling():  # pylint: disable=missing-docstring
+        for filename, tree in trees:
+            validate_report.validate_spelling(tree, filename,
+                                              validate_options)
+
+    measure('validate_spelling', spelling, options['repeat'], results)
+
+
+def benchmark_docbuilder(stubs, options, results):
+    """
+    Benchmarks the docbuilder stages on the project in the current directory.
+    """
+    saxon = options['saxon']
+    fop_binary = options['fop_binary']
+    path = os.environ['PATH']
+    if not os.path.isfile(saxon):
+        # docbuilder always executes java, so the stand-in has to replace it
+        write_stub(stubs, 'java', SAXON_STUB)
+        os.environ['PATH'] = stubs + os.pathsep + path
+        print('[*] Saxon not found, using stand-in')
+    if not os.path.isfile(fop_binary):
+        fop_binary = write_stub(stubs, 'fop', FOP_STUB)
+        print('[*] FOP not found, using stand-in')
+    fop_config = os.path.join(stubs, 'fop.xconf')
+    write_file(fop_config, '<fop version="1.0"/>\n')
+    with arguments(['-c', '--no-server', '--no-xsl-cache', '--saxon', saxon,
+                    '--fop-binary', fop_binary, '--fop-config', fop_config,
+                    '-i', 'source/report.xml',
+                    '-x', 'xslt/generate_report.xsl',
+                    '-f', 'target/report.fo',
+                    '-o', 'target/report-latest.pdf']):
+        build_options = docbuilder.parse_arguments()
+    if not os.path.isdir('target'):
+        os.makedirs('target')
+    revision = 'benchmark'
+    try:
+        measure('docbuilder to_fo', lambda: docbuilder.to_fo(build_options),
+                options['repeat'], results)
+        measure('docbuilder change_tag', lambda: docbuilder.change_tag(
+            build_options['fop'], revision), options['repeat'], results)
+        measure('docbuilder to_pdf', lambda: docbuilder.to_pdf(build_options),
+                options['repeat'], results)
+        measure('docbuilder pipe_pdf', lambda: docbuilder.pipe_pdf(
+            build_options, revision), options['repeat'], results)
+    finally:
+        os.environ['PATH'] = path
+
+
+def compare(results, filename):
+    """
+    Prints the differences between @results and the results in @filename.
+    """
+    try:
+        with open(filename) as json_file:
+            baseline = json.load(json_file)
+    except (IOError, ValueError) as exception:
+        print('[-] Could not read {0} ({1})'.format(filename, exception))
+        return
+    print('[*] Compared with {0} ({1}):'.format(filename,
+                                                baseline.get('revision')))
+    for name in sorted(results):
+        if name not in baseline['results']:
+            continue
+        old = baseline['results'][name]['min']
+        new = results[name]['min']
+        print('    {0:<28} {1:8.4f}s -> {2:8.4f}s ({3:+.1f}%)'.
+              format(name, old, new, (new - old) / old * 100 if old else 0))
+
+
+def main():
+    """
+    The main program.
+    """
+    options = parse_arguments()
+    git_dir = docbuilder.find_git_dir(os.path.dirname(
+        os.path.abspath(__file__)))
+    revision = git_dir and docbuilder.read_ref(git_dir, 'HEAD')
+    root = tempfile.mkdtemp(prefix='docbuilder-benchmark-')
+    cwd = os.getcwd()
+    results = {}
+    try:
+        files = generate_project(os.path.join(root, 'project'), options)
+        print('[*] Generated {0} files in {1}'.format(len(files), root))
+        os.chdir(os.path.join(root, 'project'))
+        if validate_report:
+            benchmark_validation(files, options, results)
+        benchmark_docbuilder(root, options, results)
+    finally:
+        os.chdir(cwd)
+        if not options['keep']:
+            shutil.rmtree(root)
+    output = {'revision': revision, 'python': sys.version.split()[0],
+              'parameters': options, 'results': results}
+    if options['output']:
+        with open(options['output'], 'w') as json_file:
+            json.dump(output, json_file, indent=2, sort_keys=True)
+    if options['compare']:
+        compare(results, options['compare'])
+
+
+if __name__ == "__main__":
+    main()
@@ -14,16 +14,57 @@ from __future__ import absolute_import
 from __future__ import print_function
 
 import argparse
+import collections
+import contextlib
+import hashlib
+import json
+import mmap
 import os
+import re
+import socket
 import subprocess
 from subprocess import PIPE
 import sys
 import textwrap
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+from xml.etree import ElementTree
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+try:
+    import yaml
+except ImportError:
+    yaml = None
 
 
 GITREV = 'GITREV'  # Magic tag which gets replaced by the git short commit hash
 OFFERTE = 'generate_offerte.xsl'  # XSL for generating waivers
 WAIVER = 'waiver_'  # prefix for waivers
+# Java classes used when running Saxon and FOP within a build server
+NAILGUN_SERVER = 'com.facebook.nailgun.NGServer'
+SAXON_CLASS = 'net.sf.saxon.Transform'
+FOP_CLASS = 'org.apache.fop.cli.Main'
+NAILGUN_CONNECT_FAILED = 230  # exit code of the ng client without server
+XSL_NAMESPACE = '{http://www.w3.org/1999/XSL/Transform}'
+XINCLUDE_NAMESPACE = '{http://www.w3.org/2001/XInclude}'
+CHUNK_SIZE = 1024 * 1024  # bytes read at once when streaming fo files
+SHORTTAG_LENGTH = 7  # length of abbreviated commit hashes, like git's %h
+REVISIONS = {}  # git revision per git directory, cached for this session
+MANIFEST = '.docbuilder-manifest.json'  # build manifest, next to the fo file
+OUTPUT_LOCK = threading.Lock()  # keeps output of parallel renders together
+MANIFEST_LOCK = threading.Lock()  # serializes updates of build manifests
+PROFILE = []  # timing records of all build stages of this session
+PROFILE_LOCK = threading.Lock()
+PROFILE_LOG = 'DOCBUILDER_PROFILE_LOG'  # environment variable for rolling log
+PROFILE_LOG_SIZE = 1024 * 1024  # rotate the rolling log above this size
+# Keys that can be specified per job in a batch file
+BATCH_KEYS = ['fop', 'input', 'output', 'params', 'xslt']
+PARAM_NAME = re.compile(r'^[A-Za-z_][\w.-]*$')  # valid stylesheet parameter
+TAIL_LINES = 20  # lines of output kept for the error summary with --live
 
 
 def parse_arguments():
@@ -42,6 +83,10 @@ This program is free software: you can redistribute it and/or modify
 it under the terms of the GNU General Public License as published by
 the Free Software Foundation, either version 3 of the License, or
 (at your option) any later version.'''))
+    parser.add_argument('--batch', action='store',
+                        help="""build all jobs in BATCH, a YAML or JSON list
+                        of jobs with input, xslt, output, fop and params
+                        keys""")
     parser.add_argument('-c', '--clobber', action='store_true',
                         help='overwrite output file if it already exists')
     parser.add_argument('-date', action='store',
@@ -57,15 +102,58 @@ the Free Software Foundation, either version 3 of the License, or
     parser.add_argument('--fop-binary', action='store',
                         default='/usr/local/bin/fop',
                         help='fop binary (default /usr/local/bin/fop')
+    parser.add_argument('--xsl-cache', action='store',
+                        default=os.path.join('~', '.cache', 'docbuilder'),
+                        help="""directory for compiled stylesheets (default
+                        ~/.cache/docbuilder)""")
+    parser.add_argument('--no-xsl-cache', action='store_true',
+                        help='do not use compiled stylesheets')
+    parser.add_argument('-j', '--jobs', action='store', type=int, default=1,
+                        help="""number of PDF files (e.g. waivers) or batch
+                        jobs to build in parallel (default 1)""")
     parser.add_argument('-i', '--input', action='store',
                         default='report.xml',
                         help="""input file (default: report.xml)""")
+    parser.add_argument('--incremental', action='store_true',
+                        help="""skip building the fo file and PDF files when
+                        their inputs are unchanged""")
+    parser.add_argument('--live', action='store_true',
+                        help="""show the output of Saxon and FOP line by line
+                        as it arrives, with timestamps""")
+    parser.add_argument('--keep-fo', action='store_true',
+                        help="""keep the intermediate fo file on disk when
+                        using --pipe""")
     parser.add_argument('-invoice', action='store',
                         help="""invoice number""")
+    parser.add_argument('--nailgun', action='store',
+                        default='/usr/local/bin/nailgun/nailgun-server.jar',
+                        help="""nailgun server JAR file (default
+                        /usr/local/bin/nailgun/nailgun-server.jar)""")
+    parser.add_argument('--ng-binary', action='store',
+                        default='/usr/local/bin/ng',
+                        help='nailgun client binary (default /usr/local/bin/ng)')
+    parser.add_argument('--no-server', action='store_true',
+                        help='do not use a running build server')
+    parser.add_argument('--pipe', action='store_true',
+                        help="""pipe the output of Saxon straight into FOP,
+                        without writing the intermediate fo file to disk
+                        (not for offertes)""")
+    parser.add_argument('--profile', action='store',
+                        help="""write timing information of all build stages
+                        as JSON to PROFILE, and show a summary""")
+    parser.add_argument('--revision', action='store',
+                        help="""revision to embed into the document instead
+                        of the git commit shorttag""")
     parser.add_argument('--saxon', action='store',
                         default='/usr/local/bin/saxon/saxon9he.jar',
                         help="""saxon JAR file (default
                         /usr/local/bin/saxon/saxon9he.jar)""")
+    parser.add_argument('--serve', action='store_true',
+                        help="""run a build server that keeps Saxon and FOP
+                        loaded, which speeds up subsequent builds""")
+    parser.add_argument('--server-port', action='store', type=int,
+                        default=2113,
+                        help='port of the build server (default 2113)')
     parser.add_argument('-x', '--xslt', action='store',
                         default='../xslt/generate_report.xsl',
                         help='input file (default: ../xslt/generate_report.xsl)')
@@ -104,66 +192,882 @@ def print_output(stdout, stderr):
         verboseerror('[-] stderr: {0}'.format(stderr))
 
 
-def change_tag(fop):
+@contextlib.contextmanager
+def profiled(stage, detail=None):
+    """
+    Records wall time, CPU time and peak RSS of the enclosed build @stage.
+    CPU time of child processes (Saxon, FOP) is only accounted after they
+    exited, and overlaps when stages run in parallel. Peak RSS is the peak of
+    the process (and its children) so far, in kilobytes.
+    """
+    start = time.time()
+    times = os.times()
+    try:
+        yield
+    finally:
+        end = os.times()
+        record = {'stage': stage, 'detail': detail, 'start': start,
+                  'wall': time.time() - start,
+                  'cpu': (end[0] + end[1]) - (times[0] + times[1]),
+                  'cpu_children': (end[2] + end[3]) - (times[2] + times[3])}
+        if resource:
+            record['max_rss'] = resource.getrusage(
+                resource.RUSAGE_SELF).ru_maxrss
+            record['max_rss_children'] = resource.getrusage(
+                resource.RUSAGE_CHILDREN).ru_maxrss
+        with PROFILE_LOCK:
+            PROFILE.append(record)
+
+
+def write_profile(options, total):
+    """
+    Writes the timing records to the --profile file and prints a summary, and
+    appends the records to the rolling log named by PROFILE_LOG.
+    """
+    if options['profile']:
+        try:
+            with open(options['profile'], 'w') as json_file:
+                json.dump({'argv': sys.argv[1:], 'total': total,
+                           'stages': PROFILE}, json_file, indent=2)
+        except IOError as exception:
+            print('[-] Could not write profile {0} ({1})'.
+                  format(options['profile'], exception.strerror),
+                  file=sys.stderr)
+        print('[*] Profile ({0:.2f} seconds in total):'.format(total))
+        print('    {0:<10} {1:>5} {2:>9} {3:>9} {4:>9} {5:>10}'.format(
+            'stage', 'count', 'wall', 'cpu', 'children', 'peak rss*'))
+        for stage in sorted(set(record['stage'] for record in PROFILE)):
+            records = [record for record in PROFILE if record['stage'] == stage]
+            print('    {0:<10} {1:>5} {2:>9.3f} {3:>9.3f} {4:>9.3f} {5:>10}'.
+                  format(stage, len(records),
+                         sum(record['wall'] for record in records),
+                         sum(record['cpu'] for record in records),
+                         sum(record['cpu_children'] for record in records),
+                         max(max(record.get('max_rss', 0),
+                                 record.get('max_rss_children', 0))
+                             for record in records)))
+        print('    * peak RSS of the whole build so far when the stage ended')
+    log = os.getenv(PROFILE_LOG)
+    if log:
+        try:
+            if os.path.isfile(log) and os.path.getsize(log) > PROFILE_LOG_SIZE:
+                if os.path.isfile(log + '.1'):
+                    os.remove(log + '.1')
+                os.rename(log, log + '.1')
+            with open(log, 'a') as log_file:
+                for record in PROFILE:
+                    log_file.write(json.dumps(dict(record,
+                                                   cwd=os.getcwd())) + '\n')
+        except (IOError, OSError) as exception:
+            print('[-] Could not append to profile log {0} ({1})'.
+                  format(log, exception.strerror), file=sys.stderr)
+
+
+def server_running(options):
+    """
+    Checks whether a build server is listening on the server port.
+    Returns True if that's the case.
+    """
+    if options['no_server']:
+        return False
+    try:
+        connection = socket.create_connection(('127.0.0.1',
+                                               options['server_port']), 0.5)
+        connection.close()
+    except (socket.error, socket.timeout):
+        return False
+    return True
+
+
+def fop_classpath(options):
+    """
+    Returns a list of classpath entries for FOP, based on the location of the
+    (symlinked) fop binary.
+    """
+    fop_home = os.path.dirname(os.path.realpath(options['fop_binary']))
+    return [os.path.join(fop_home, 'build', 'fop.jar'),
+            os.path.join(fop_home, 'lib', '*')]
+
+
+def serve(options):
+    """
+    Runs a nailgun build server which keeps Saxon and FOP loaded in one JVM.
+    Returns the exit code of the server.
+    """
+    for required in (options['nailgun'], options['saxon']):
+        if not os.path.isfile(required):
+            print_exit('[-] Could not find {0}: the build server needs the '
+                       'nailgun server and Saxon JAR files (see --nailgun and '
+                       '--saxon)'.format(required), -1)
+    classpath = [options['nailgun'], options['saxon']] + fop_classpath(options)
+    cmd = ['java', '-cp', os.pathsep.join(classpath), NAILGUN_SERVER,
+           '127.0.0.1:{0}'.format(options['server_port'])]
+    print('[+] Starting build server on port {0}'.
+          format(options['server_port']))
+    verboseprint(' '.join(cmd))
+    try:
+        return subprocess.call(cmd)
+    except OSError as exception:
+        print_exit('[-] ERR: {0}'.format(exception.strerror), exception.errno)
+    except KeyboardInterrupt:
+        print('[+] Build server stopped')
+    return 0
+
+
+def java_command(options, main_class, prefix, arguments):
+    """
+    Returns the command line for running @main_class with @arguments on the
+    build server, and the fallback command line starting with @prefix for when
+    the build server cannot be reached.
+    When no build server is running, returns the fallback command line and
+    None.
+    """
+    if server_running(options):
+        verboseprint('Using build server on port {0}'.
+                     format(options['server_port']))
+        return ([options['ng_binary'], '--nailgun-port',
+                 str(options['server_port']), main_class] + arguments,
+                prefix + arguments)
+    return prefix + arguments, None
+
+
+def execute(cmd, fallback=None, live=None):
+    """
+    Executes @cmd, and executes @fallback instead when @cmd could not reach
+    the build server.
+    When @live is given, shows the output line by line as it arrives, labeled
+    with @live, and only keeps the last TAIL_LINES lines.
+    Returns the return code, standard out and standard error.
+    """
+    try:
+        process = subprocess.Popen(cmd, stdout=PIPE, stderr=PIPE)
+        if live:
+            stdout, stderr = stream_output(process, live)
+        else:
+            stdout, stderr = process.communicate()
+    except OSError:
+        if not fallback:
+            raise
+        verboseerror('[-] Could not execute {0}, falling back'.format(cmd[0]))
+        return execute(fallback, live=live)
+    if fallback and process.returncode == NAILGUN_CONNECT_FAILED:
+        verboseerror('[-] Build server not reachable, falling back')
+        return execute(fallback, live=live)
+    return process.returncode, stdout, stderr
+
+
+def start_process(cmd, fallback=None, **kwargs):
+    """
+    Starts @cmd with the Popen arguments @kwargs, and starts @fallback instead
+    when @cmd can't be executed.
+    Returns the process and the fallback that is still left, if any.
+    """
+    try:
+        return subprocess.Popen(cmd, **kwargs), fallback
+    except OSError:
+        if not fallback:
+            raise
+        verboseerror('[-] Could not execute {0}, falling back'.format(cmd[0]))
+        return subprocess.Popen(fallback, **kwargs), None
+
+
+def read_lines(stream, lines, label=None, start=None, output=None):
+    """
+    Reads @stream line by line until it is closed, and appends the lines to
+    @lines. When @start is given, also shows each line on @output as it
+    arrives, with @label and the seconds elapsed since @start.
+    """
+    for line in iter(stream.readline, b''):
+        line = line.decode('utf-8', 'replace').rstrip('\r\n')
+        lines.append(line)
+        if start is not None:
+            with OUTPUT_LOCK:
+                print('[{0:7.1f}s {1}] {2}'.format(time.time() - start, label,
+                                                   line), file=output)
+                output.flush()
+
+
+def stream_output(process, label):
+    """
+    Shows standard out and standard error of @process line by line as they
+    arrive, until @process exits. Reading happens in threads, as pipes can't
+    be polled on every platform.
+    Returns the last TAIL_LINES lines of standard out and standard error.
+    """
+    start = time.time()
+    stdout = collections.deque(maxlen=TAIL_LINES)
+    stderr = collections.deque(maxlen=TAIL_LINES)
+    threads = [threading.Thread(target=read_lines,
+                                args=(stream, lines, label, start, output))
+               for stream, lines, output in ((process.stdout, stdout,
+                                              sys.stdout),
+                                             (process.stderr, stderr,
+                                              sys.stderr))]
+    for thread in threads:
+        thread.start()
+    process.wait()
+    for thread in threads:
+        thread.join()
+    return '\n'.join(stdout), '\n'.join(stderr)
+
+
+def print_tail(label, stderr):
+    """
+    Repeats the last lines of standard error of @label, which were already
+    shown with --live, as summary of an error.
+    """
+    if stderr:
+        print('[-] Last lines of {0} output:\n{1}'.format(label, stderr),
+              file=sys.stderr)
+
+
+def stylesheet_files(xslt, found=None):
+    """
+    Returns a sorted list of @xslt and all stylesheets it includes or
+    imports, recursively.
+    """
+    if found is None:
+        found = set()
+    xslt = os.path.normpath(os.path.abspath(xslt))
+    if xslt in found:
+        return sorted(found)
+    found.add(xslt)
+    try:
+        root = ElementTree.parse(xslt).getroot()
+    except (ElementTree.ParseError, IOError):
+        return sorted(found)  # Saxon will report the error
+    for tag in ('include', 'import'):
+        for element in root.iter(XSL_NAMESPACE + tag):
+            href = element.get('href')
+            if href and '://' not in href:
+                stylesheet_files(os.path.join(os.path.dirname(xslt), href),
+                                 found)
+    return sorted(found)
+
+
+def hash_files(filenames, digest=None):
+    """
+    Returns a hash object over the names and contents of @filenames.
+    """
+    if digest is None:
+        digest = hashlib.sha256()
+    for filename in filenames:
+        digest.update(filename.encode('utf-8'))
+        try:
+            with open(filename, 'rb') as hashed_file:
+                for chunk in iter(lambda: hashed_file.read(65536), b''):
+                    digest.update(chunk)
+        except IOError:
+            digest.update(b'missing')
+    return digest
+
+
+def compiled_stylesheet(options):
+    """
+    Returns the compiled version of the stylesheet, keyed by the contents of
+    the stylesheet and all its dependencies, and by the Saxon JAR file.
+    Compiles the stylesheet when it isn't cached yet.
+    Returns the original stylesheet if it cannot be compiled.
+    """
+    xslt = os.path.abspath(options['xslt'])
+    if options['no_xsl_cache']:
+        return xslt
+    cache_dir = os.path.expanduser(options['xsl_cache'])
+    digest = hash_files(stylesheet_files(xslt))
+    # Compiled stylesheets (and failures) depend on the Saxon edition/version
+    saxon = os.path.realpath(options['saxon'])
+    try:
+        digest.update('{0}:{1}:{2}'.format(saxon, os.path.getmtime(saxon),
+                                           os.path.getsize(saxon)).
+                      encode('utf-8'))
+    except OSError:
+        digest.update(saxon.encode('utf-8'))
+    key = digest.hexdigest()
+    compiled = os.path.join(cache_dir, key + '.sef')
+    failed = os.path.join(cache_dir, key + '.failed')
+    if os.path.isfile(compiled):
+        verboseprint('Using compiled stylesheet {0}'.format(compiled))
+        return compiled
+    if os.path.isfile(failed):
+        return xslt
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        temporary = '{0}.{1}'.format(compiled, os.getpid())
+        arguments = ['-xsl:' + xslt, '-export:' + temporary, '-nogo']
+        cmd, fallback = java_command(options, SAXON_CLASS,
+                                     ['java', '-jar', options['saxon']],
+                                     arguments)
+        with profiled('compile', xslt):
+            returncode, stdout, stderr = execute(cmd, fallback)
+        if not returncode and os.path.isfile(temporary):
+            os.rename(temporary, compiled)
+            verboseprint('Compiled stylesheet into {0}'.format(compiled))
+            return compiled
+        # Only some Saxon editions are able to export stylesheets
+        print_output(stdout, stderr)
+        verboseerror('[-] Could not compile {0}, using source'.format(xslt))
+        open(failed, 'w').close()
+    except OSError as exception:
+        verboseerror('[-] Could not cache compiled stylesheet ({0})'.
+                     format(exception.strerror))
+    return xslt
+
+
+def xml_files(filename, found=None):
+    """
+    Returns a sorted list of @filename and all files it XIncludes,
+    recursively.
+    """
+    if found is None:
+        found = set()
+    filename = os.path.normpath(os.path.abspath(filename))
+    if filename in found:
+        return sorted(found)
+    found.add(filename)
+    try:
+        root = ElementTree.parse(filename).getroot()
+    except (ElementTree.ParseError, IOError):
+        return sorted(found)  # Saxon will report the error
+    for element in root.iter(XINCLUDE_NAMESPACE + 'include'):
+        href = element.get('href')
+        if not href or '://' in href:
+            continue
+        included = os.path.join(os.path.dirname(filename), href)
+        if element.get('parse') == 'text':
+            found.add(os.path.normpath(os.path.abspath(included)))
+        else:
+            xml_files(included, found)
+    return sorted(found)
+
+
+def font_signature(fop_config):
+    """
+    Returns a list of (filename, size, modification time) tuples of the font
+    files referenced by @fop_config. Font files are big, so they are tracked
+    by their metadata instead of by their contents.
+    """
+    signature = []
+    try:
+        root = ElementTree.parse(fop_config).getroot()
+    except (ElementTree.ParseError, IOError):
+        return signature
+    font_base = root.findtext('font-base') or os.path.dirname(fop_config)
+    fonts = []
+    for element in root.iter('font'):
+        for attribute in ('embed-url', 'metrics-url'):
+            if element.get(attribute):
+                fonts.append(os.path.join(font_base, element.get(attribute)))
+    for element in root.iter('directory'):
+        for path, _dirs, files in os.walk((element.text or '').strip()):
+            fonts += [os.path.join(path, name) for name in files]
+            if element.get('recursive') != 'true':
+                break
+    for font in sorted(fonts):
+        try:
+            stat = os.stat(font)
+            signature.append((font, stat.st_size, stat.st_mtime))
+        except OSError:
+            signature.append((font, None, None))
+    return signature
+
+
+def fo_key(options, revision):
+    """
+    Returns a key over everything that determines the contents of the fo file:
+    the XML input and its XIncludes, the stylesheets, the parameters and the
+    git revision.
+    """
+    with profiled('hash', options['input']):
+        digest = hash_files(xml_files(options['input']))
+        digest = hash_files(stylesheet_files(options['xslt']), digest)
+        digest.update(json.dumps([options['invoice'], options['date'],
+                                  sorted((options.get('params') or
+                                          {}).items()),
+                                  revision]).encode('utf-8'))
+        return digest.hexdigest()
+
+
+def fo_digest(options):
+    """
+    Returns a hash of the contents of the fo file as it is on disk.
+    """
+    with profiled('hash', options['fop']):
+        return hash_files([os.path.abspath(options['fop'])]).hexdigest()
+
+
+def pdf_key(options, source=None):
+    """
+    Returns a key over everything that determines the contents of the PDF
+    file: the fo file, the fop configuration and the fonts.
+    When the fo file isn't written to disk, @source (the key of the fo file)
+    is used instead of the fo file.
+    """
+    with profiled('hash', options['output']):
+        if source:
+            digest = hashlib.sha256(source.encode('utf-8'))
+            digest = hash_files([os.path.abspath(options['fop_config'])], digest)
+        else:
+            digest = hash_files([os.path.abspath(options['fop']),
+                                 os.path.abspath(options['fop_config'])])
+        digest.update(json.dumps(font_signature(options['fop_config'])).
+                      encode('utf-8'))
+        return digest.hexdigest()
+
+
+def read_manifest(options):
+    """
+    Returns the build manifest, containing the keys of previous builds.
+    """
+    with profiled('manifest', None):
+        return load_manifest(options)
+
+
+def load_manifest(options):
+    """
+    Loads the build manifest from disk, without recording a profile stage.
+    """
+    manifest = {'fo': {}, 'pdf': {}}
+    try:
+        with open(manifest_file(options)) as json_file:
+            manifest.update(json.load(json_file))
+    except (IOError, ValueError):
+        pass
+    return manifest
+
+
+def write_manifest(options, manifest):
+    """
+    Merges @manifest into the build manifest on disk, so that builds sharing
+    a manifest don't overwrite each other's keys.
+    """
+    with profiled('manifest', None):
+        try:
+            with MANIFEST_LOCK:
+                merged = load_manifest(options)
+                for stage in ('fo', 'pdf'):
+                    merged[stage].update(manifest[stage])
+                with open(manifest_file(options), 'w') as json_file:
+                    json.dump(merged, json_file, indent=2, sort_keys=True)
+        except IOError as exception:
+            verboseerror('[-] Could not write build manifest ({0})'.
+                         format(exception.strerror))
+
+
+def manifest_file(options):
+    """
+    Returns the name of the build manifest.
+    """
+    return os.path.join(os.path.dirname(os.path.abspath(options['fop'])),
+                        MANIFEST)
+
+
+def find_git_dir(path):
+    """
+    Returns the git directory of the repository containing @path, or None if
+    @path isn't part of a git repository.
+    """
+    path = os.path.abspath(path)
+    while True:
+        git_dir = os.path.join(path, '.git')
+        if os.path.isdir(git_dir):
+            return git_dir
+        if os.path.isfile(git_dir):  # worktrees and submodules
+            with open(git_dir) as git_file:
+                contents = git_file.read().strip()
+            if contents.startswith('gitdir:'):
+                return os.path.normpath(os.path.join(
+                    path, contents[len('gitdir:'):].strip()))
+        parent = os.path.dirname(path)
+        if parent == path:
+            return None
+        path = parent
+
+
+def read_ref(git_dir, ref):
+    """
+    Returns the commit hash of @ref (e.g. HEAD or refs/heads/master) by reading
+    loose and packed refs, or None if it could not be resolved.
+    """
+    common_dir = git_dir
+    if os.path.isfile(os.path.join(git_dir, 'commondir')):
+        with open(os.path.join(git_dir, 'commondir')) as common_file:
+            common_dir = os.path.normpath(
+                os.path.join(git_dir, common_file.read().strip()))
+    for directory in (git_dir, common_dir):
+        try:
+            with open(os.path.join(directory, ref)) as ref_file:
+                value = ref_file.read().strip()
+        except IOError:
+            continue
+        if value.startswith('ref:'):
+            return read_ref(git_dir, value[len('ref:'):].strip())
+        return value or None
+    try:
+        with open(os.path.join(common_dir, 'packed-refs')) as packed_file:
+            for line in packed_file:
+                if line.startswith(('#', '^')):
+                    continue
+                fields = line.split()
+                if len(fields) == 2 and fields[1] == ref:
+                    return fields[0]
+    except IOError:
+        pass
+    return None
+
+
+def git_revision(options):
+    """
+    Returns the revision to embed into documents: the --revision option, or
+    the git commit shorttag read straight from the .git directory.
+    The shorttag is cached for this session.
+    Returns None if it could not be determined.
+    """
+    if options['revision']:
+        return options['revision']
+    git_dir = find_git_dir(os.getcwd())
+    if not git_dir:
+        verboseprint('Not a git repository, not embedding git version')
+        return None
+    if git_dir not in REVISIONS:
+        commit = read_ref(git_dir, 'HEAD')
+        REVISIONS[git_dir] = commit[:SHORTTAG_LENGTH] if commit else None
+        if not commit:
+            verboseprint('Could not read git revision from {0}'.format(git_dir))
+    return REVISIONS[git_dir]
+
+
+def stylesheet_params(xslt):
+    """
+    Returns the names of all global parameters declared by @xslt and the
+    stylesheets it includes or imports.
+    """
+    params = set()
+    for stylesheet in stylesheet_files(xslt):
+        try:
+            root = ElementTree.parse(stylesheet).getroot()
+        except (ElementTree.ParseError, IOError):
+            continue
+        params.update(element.get('name') for element in
+                      root.findall(XSL_NAMESPACE + 'param'))
+    return params
+
+
+def replace_chunks(chunks, old, new):
+    """
+    Replaces @old by @new in a stream of byte @chunks, without keeping more
+    than one chunk in memory. Matches spanning two chunks are replaced too.
+    Yields the replaced chunks.
+    """
+    keep = len(old) - 1  # the largest part of @old a chunk can end with
+    buffer = b''
+    for chunk in chunks:
+        parts = (buffer + chunk).split(old)
+        tail = parts.pop()
+        cut = max(len(tail) - keep, 0)
+        yield new.join(parts + [tail[:cut]])
+        buffer = tail[cut:]
+    yield buffer
+
+
+def contains_tag(filename, tag):
+    """
+    Checks whether @filename contains @tag, without reading it into memory.
+    Returns True if that's the case.
+    """
+    with open(filename, 'rb') as fop_file:
+        if not os.fstat(fop_file.fileno()).st_size:
+            return False
+        mapped = mmap.mmap(fop_file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return mapped.find(tag) != -1
+        finally:
+            mapped.close()
+
+
+def change_tag(fop, shorttag):
     """
     Replaces GITREV in document by git commit shorttag.
+    The file is rewritten in chunks, so that huge fo files don't need to fit in
+    memory.
     """
-    cmd = ['git', 'log', '--pretty=format:%h', '-n', '1']
-    process = subprocess.Popen(cmd, stdout=subprocess.PIPE)
-    shorttag, _stderr = process.communicate()
-    if not process.returncode:
-        fop_file = open(fop).read()
-        if GITREV in fop_file:
-            fop_file = fop_file.replace(GITREV, shorttag)
-            with open(fop, 'w') as new_file:
-                new_file.write(fop_file)
-            print('[+] Embedding git version information into document')
+    with profiled('gitrev', fop):
+        if not shorttag or not contains_tag(fop, GITREV.encode('utf-8')):
+            return
+        temporary = fop + '.tmp'
+        with open(fop, 'rb') as fop_file:
+            with open(temporary, 'wb') as new_file:
+                for chunk in replace_chunks(iter(lambda: fop_file.read(CHUNK_SIZE),
+                                                 b''),
+                                            GITREV.encode('utf-8'),
+                                            shorttag.encode('utf-8')):
+                    new_file.write(chunk)
+        os.rename(temporary, fop)
+        print('[+] Embedding git version information into document')
 
 
-def to_fo(options):
+def saxon_arguments(options, revision=None, output=None):
     """
-    Creates a fo output file based on a XML file.
-    Returns True if successful
+    Returns the Saxon arguments for transforming the input file into @output,
+    or to standard out when @output is None.
     """
-    cmd = ['java', '-jar', options['saxon'],
-           '-s:' + options['input'], '-xsl:' + options['xslt'],
-           '-o:' + options['fop'], '-xi']
+    # The build server resolves relative paths against its own directory
+    arguments = ['-s:' + os.path.abspath(options['input']),
+                 '-xsl:' + compiled_stylesheet(options)]
+    if output:
+        arguments.append('-o:' + os.path.abspath(output))
+    arguments.append('-xi')
     if options['invoice']:
-        cmd.append('INVOICE_NO=' + options['invoice'])
+        arguments.append('INVOICE_NO=' + options['invoice'])
     if options['date']:
-        cmd.append('DATE=' + options['date'])
-    process = subprocess.Popen(cmd, stdout=PIPE, stderr=PIPE)
-    stdout, stderr = process.communicate()
-    print_output(stdout, stderr)
-    if process.returncode:
-        print_exit('[-] Error creating fo file from XML input',
-                   process.returncode)
-    else:
-        change_tag(options['fop'])
+        arguments.append('DATE=' + options['date'])
+    params = options.get('params') or {}
+    for name in sorted(params):
+        arguments.append('{0}={1}'.format(name, params[name]))
+    if revision:
+        arguments.append(GITREV + '=' + revision)
+    return arguments
+
+
+def to_fo(options, revision=None):
+    """
+    Creates a fo output file based on a XML file.
+    Returns True if successful
+    """
+    cmd, fallback = java_command(options, SAXON_CLASS,
+                                 ['java', '-jar', options['saxon']],
+                                 saxon_arguments(options, revision,
+                                                 options['fop']))
+    with profiled('saxon', options['input']):
+        returncode, stdout, stderr = execute(cmd, fallback,
+                                             options['live'] and 'saxon')
+    with OUTPUT_LOCK:
+        if options['live']:
+            if returncode:
+                print_tail('saxon', stderr)
+        else:
+            print_output(stdout, stderr)
+        if returncode:
+            print('[-] Error creating fo file from XML input {0}'.
+                  format(options['input']), file=sys.stderr)
+    if returncode:
+        return False
+    # Stylesheets declaring the GITREV parameter embed the revision themselves
+    if GITREV not in stylesheet_params(options['xslt']):
+        change_tag(options['fop'], revision)
     return True
 
 
-def to_pdf(options):
+def to_pdf(options, manifest=None):
     """
     Creates a PDF file based on a fo file.
+    When @manifest is given, skips the build if the PDF file is up to date,
+    and records the build in @manifest.
     Returns True if successful
     """
-    cmd = [options['fop_binary'], '-c', options['fop_config'], options['fop'],
-           options['output']]
+    if manifest is not None:
+        key = pdf_key(options)
+        if manifest['pdf'].get(os.path.abspath(options['output'])) == key \
+           and os.path.isfile(options['output']):
+            print('[+] {0} is up to date'.format(options['output']))
+            return True
+        if os.path.isfile(options['output']):
+            os.remove(options['output'])
+    arguments = ['-c', os.path.abspath(options['fop_config']),
+                 os.path.abspath(options['fop']),
+                 os.path.abspath(options['output'])]
+    cmd, fallback = java_command(options, FOP_CLASS, [options['fop_binary']],
+                                 arguments)
     try:
         verboseprint('Converting {0} to {1}'.format(options['fop'],
                                                     options['output']))
-        process = subprocess.Popen(cmd, stdout=PIPE, stderr=PIPE)
-        stdout, stderr = process.communicate()
-        result = process.returncode
-        print_output(stdout, stderr)
-        if result == 0:
-            print('[+] Succesfully built ' + options['output'])
+        with profiled('fop', options['output']):
+            result, stdout, stderr = execute(cmd, fallback,
+                                             options['live'] and 'fop')
+        with OUTPUT_LOCK:
+            if options['live']:
+                if result:
+                    print_tail('fop', stderr)
+            else:
+                print_output(stdout, stderr)
+            if result == 0:
+                print('[+] Succesfully built ' + options['output'])
+        if result == 0 and manifest is not None:
+            manifest['pdf'][os.path.abspath(options['output'])] = key
     except OSError as exception:
-        print_exit('[-] ERR: {0}'.format(exception.strerror), exception.errno)
+        with OUTPUT_LOCK:
+            print('[-] ERR: {0} ({1})'.format(exception.strerror,
+                                              options['output']),
+                  file=sys.stderr)
+        return False
     return result == 0
 
 
+def read_stream(stream, output, name):
+    """
+    Reads @stream until it is closed, and stores the contents in @output under
+    @name.
+    """
+    output[name] = stream.read()
+
+
+def pipe_pdf(options, revision=None):
+    """
+    Creates a PDF file by piping the output of Saxon straight into FOP.
+    The fo file is only written to disk when options['keep_fo'] or
+    options['verbose'].
+    Returns True if successful
+    """
+    saxon_cmd, fallback = java_command(options, SAXON_CLASS,
+                                       ['java', '-jar', options['saxon']],
+                                       saxon_arguments(options, revision))
+    fop_cmd, fop_fallback = java_command(options, FOP_CLASS,
+                                         [options['fop_binary']],
+                                         ['-c', os.path.abspath(
+                                             options['fop_config']), '-fo',
+                                          '-', '-pdf', os.path.abspath(
+                                              options['output'])])
+    verboseprint('Piping {0} into {1}'.format(options['input'],
+                                              options['output']))
+    try:
+        saxon, fallback = start_process(saxon_cmd, fallback, stdout=PIPE,
+                                        stderr=PIPE)
+    except OSError as exception:
+        print('[-] ERR: {0}'.format(exception.strerror), file=sys.stderr)
+        return False
+    try:
+        fop, fop_fallback = start_process(fop_cmd, fop_fallback, stdin=PIPE,
+                                          stdout=PIPE, stderr=PIPE)
+    except OSError as exception:
+        saxon.kill()
+        saxon.wait()
+        print('[-] ERR: {0}'.format(exception.strerror), file=sys.stderr)
+        return False
+    output = {}
+    if options['live']:
+        start = time.time()
+        for name in ('saxon', 'stdout', 'stderr'):
+            output[name] = collections.deque(maxlen=TAIL_LINES)
+        threads = [threading.Thread(target=read_lines,
+                                    args=(stream, output[name], label, start,
+                                          target))
+                   for stream, name, label, target in (
+                       (saxon.stderr, 'saxon', 'saxon', sys.stderr),
+                       (fop.stdout, 'stdout', 'fop', sys.stdout),
+                       (fop.stderr, 'stderr', 'fop', sys.stderr))]
+    else:
+        threads = [threading.Thread(target=read_stream,
+                                    args=(stream, output, name))
+                   for stream, name in ((saxon.stderr, 'saxon'),
+                                        (fop.stdout, 'stdout'),
+                                        (fop.stderr, 'stderr'))]
+    for thread in threads:
+        thread.start()
+    chunks = iter(lambda: saxon.stdout.read(CHUNK_SIZE), b'')
+    # Stylesheets declaring the GITREV parameter embed the revision themselves
+    if revision and GITREV not in stylesheet_params(options['xslt']):
+        chunks = replace_chunks(chunks, GITREV.encode('utf-8'),
+                                revision.encode('utf-8'))
+    fo_file = None
+    fop_stopped = False
+    if options['keep_fo'] or options['verbose']:
+        fo_file = open(options['fop'], 'wb')
+    try:
+        for chunk in chunks:
+            if fo_file:
+                fo_file.write(chunk)
+            fop.stdin.write(chunk)
+    except (IOError, OSError):  # FOP stopped reading
+        fop_stopped = True
+        saxon.kill()
+    finally:
+        if fo_file:
+            fo_file.close()
+        try:
+            fop.stdin.close()
+        except (IOError, OSError):
+            pass
+    saxon.wait()
+    fop.wait()
+    for thread in threads:
+        thread.join()
+    if (fallback and saxon.returncode == NAILGUN_CONNECT_FAILED) or \
+       (fop_fallback and fop.returncode == NAILGUN_CONNECT_FAILED):
+        verboseerror('[-] Build server not reachable, falling back')
+        return pipe_pdf(dict(options, no_server=True), revision)
+    # When FOP stops early, Saxon got killed and isn't the one to blame
+    saxon_failed = saxon.returncode and not (fop_stopped and fop.returncode)
+    with OUTPUT_LOCK:
+        if options['live']:
+            if saxon_failed:
+                print_tail('saxon', '\n'.join(output['saxon']))
+            elif fop.returncode:
+                print_tail('fop', '\n'.join(output['stderr']))
+        else:
+            print_output(None, output['saxon'])
+            print_output(output['stdout'], output['stderr'])
+        if saxon_failed:
+            print('[-] Error creating fo file from XML input {0}'.
+                  format(options['input']), file=sys.stderr)
+        elif fop.returncode:
+            print('[-] Error creating PDF file {0} from fo stream'.
+                  format(options['output']), file=sys.stderr)
+        else:
+            print('[+] Succesfully built ' + options['output'])
+    if (saxon.returncode or fop.returncode) and \
+       os.path.isfile(options['output']):
+        os.remove(options['output'])
+    return not (saxon.returncode or fop.returncode)
+
+
+def pipe_build(options, revision=None):
+    """
+    Builds the PDF file by piping Saxon into FOP. When options['incremental'],
+    skips the build if the PDF file is up to date.
+    Returns True if successful.
+    """
+    key = None
+    if options['incremental']:
+        key = pdf_key(options, fo_key(options, revision))
+        if read_manifest(options)['pdf'].get(
+                os.path.abspath(options['output'])) == key and \
+           os.path.isfile(options['output']):
+            print('[+] {0} is up to date'.format(options['output']))
+            return True
+        if os.path.isfile(options['output']):
+            os.remove(options['output'])
+    with profiled('pipe', options['output']):
+        result = pipe_pdf(options, revision)
+    if result and key:
+        write_manifest(options, {'fo': {},
+                                 'pdf': {os.path.abspath(options['output']):
+                                         key}})
+    return result
+
+
+def render_all(renders, options, manifest=None):
+    """
+    Creates PDF files for all @renders (options per fo file), using
+    options['jobs'] parallel renders.
+    Returns True if all PDF files were built successfully.
+    """
+    if options['jobs'] > 1 and len(renders) > 1:
+        pool = ThreadPool(min(options['jobs'], len(renders)))
+        try:
+            results = pool.map(lambda render: to_pdf(render, manifest),
+                               renders)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [to_pdf(render, manifest) for render in renders]
+    failed = [render['output'] for render, result in zip(renders, results)
+              if not result]
+    for output in failed:
+        print('[-] Could not build {0}'.format(output), file=sys.stderr)
+    return not failed
+
+
 def print_exit(text, result):
     """
     Prints error message and exits with result code.
@@ -172,52 +1076,191 @@ def print_exit(text, result):
     sys.exit(result)
 
 
-def main():
+def build(options, revision=None):
     """
-    The main program.
+    Builds the PDF file(s) for one input file.
+    Returns True if successful.
     """
-    global verboseerror
-    global verboseprint
-    result = False
-    options = parse_arguments()
     if not os.path.isfile(options['input']):
-        print_exit('[-] Cannot find input file {0}'.
-                   format(options['input']), result)
+        print('[-] Cannot find input file {0}'.format(options['input']),
+              file=sys.stderr)
+        return False
     try:
         if os.path.isfile(options['output']):
             if not options['clobber']:
-                print_exit('[-] Output file {0} already exists. '.
-                           format(options['output']) +
-                           'Use -c (clobber) to overwrite',
-                           result)
-            os.remove(options['output'])
+                print('[-] Output file {0} already exists. '.
+                      format(options['output']) +
+                      'Use -c (clobber) to overwrite', file=sys.stderr)
+                return False
+            if not options['incremental']:
+                os.remove(options['output'])
     except OSError as exception:
-        print_exit('[-] Could not remove/overwrite file {0} ({1})'.
-                   format(options['output'], exception.strerror), result)
-    result = to_fo(options)
-    if result:
-        if OFFERTE in options['xslt']:  # an offerte can generate multiple fo's
-            report_output = options['output']
-            verboseprint('generating separate waivers detected')
-            output_dir = os.path.dirname(options['output'])
-            fop_dir = os.path.dirname(options['fop'])
-            try:
-                for fop in [os.path.splitext(x)[0] for x in
-                            os.listdir(fop_dir) if x.endswith('fo')]:
-                    if WAIVER in fop:
-                        options['output'] = output_dir + os.sep + fop + '.pdf'
-                    else:
-                        options['output'] = report_output
-                    options['fop'] = fop_dir + os.sep + fop + '.fo'
-                    result = to_pdf(options) and result
-            except OSError as exception:
-                print_exit('[-] ERR: {0}'.format(exception.strerror),
-                           exception.errno)
+        print('[-] Could not remove/overwrite file {0} ({1})'.
+              format(options['output'], exception.strerror), file=sys.stderr)
+        return False
+    if options['pipe']:
+        if OFFERTE not in options['xslt']:
+            return pipe_build(options, revision)
+        # Waivers are written next to the fo file, so it has to be on disk
+        verboseprint('Cannot pipe offertes, writing fo file')
+    manifest = None
+    if options['incremental']:
+        previous = read_manifest(options)
+        manifest = {'fo': {}, 'pdf': dict(previous['pdf'])}
+        key = fo_key(options, revision)
+        # The fo file may have been overwritten by another build since, so
+        # its hash is recorded together with the key
+        recorded = previous['fo'].get(os.path.abspath(options['fop']))
+        if isinstance(recorded, list) and recorded[0] == key and \
+           os.path.isfile(options['fop']) and \
+           recorded[1:] == [fo_digest(options)]:
+            print('[+] {0} is up to date'.format(options['fop']))
+            result = True
         else:
-            result = to_pdf(options)
+            result = to_fo(options, revision)
+            if result:
+                manifest['fo'][os.path.abspath(options['fop'])] = \
+                    [key, fo_digest(options)]
+    else:
+        result = to_fo(options, revision)
+    if not result:
+        return False
+    renders = [options]
+    if OFFERTE in options['xslt']:  # an offerte can generate multiple fo's
+        verboseprint('generating separate waivers detected')
+        output_dir = os.path.dirname(options['output'])
+        fop_dir = os.path.dirname(options['fop'])
+        try:
+            for fop in sorted([os.path.splitext(x)[0] for x in
+                               os.listdir(fop_dir) if x.endswith('.fo')]):
+                if fop.startswith(WAIVER):
+                    render = dict(options)
+                    render['output'] = output_dir + os.sep + fop + '.pdf'
+                    render['fop'] = fop_dir + os.sep + fop + '.fo'
+                    renders.append(render)
+        except OSError as exception:
+            print('[-] ERR: {0}'.format(exception.strerror), file=sys.stderr)
+            return False
+    result = render_all(renders, options, manifest)
+    if manifest is not None:
+        write_manifest(options, manifest)
+    return result
+
+
+def read_batch(filename):
+    """
+    Reads a list of jobs from the YAML or JSON file @filename.
+    """
+    errors = (IOError, ValueError)
+    if yaml:
+        errors += (yaml.YAMLError,)
+    try:
+        with open(filename) as batch_file:
+            if yaml and not filename.lower().endswith('.json'):
+                jobs = yaml.safe_load(batch_file)
+            else:
+                jobs = json.load(batch_file)
+    except errors as exception:
+        print_exit('[-] Could not read batch file {0} ({1})'.
+                   format(filename, exception), -1)
+    if not isinstance(jobs, list) or \
+       not all(isinstance(job, dict) for job in jobs):
+        print_exit('[-] Batch file {0} should contain a list of jobs'.
+                   format(filename), -1)
+    for job in jobs:
+        unknown = set(job) - set(BATCH_KEYS)
+        if unknown:
+            print_exit('[-] Unknown key(s) in batch file {0}: {1}'.
+                       format(filename, ', '.join(sorted(unknown))), -1)
+        params = job.get('params') or {}
+        if not isinstance(params, dict):
+            print_exit('[-] params in batch file {0} should be a mapping'.
+                       format(filename), -1)
+        invalid = [name for name in params if name == GITREV or
+                   not PARAM_NAME.match(str(name))]
+        if invalid:
+            print_exit('[-] Invalid stylesheet parameter(s) in batch file '
+                       '{0}: {1} (use --revision for {2})'.
+                       format(filename, ', '.join(sorted(map(str, invalid))),
+                              GITREV), -1)
+    return jobs
+
+
+def job_options(options, job):
+    """
+    Returns the options for one batch @job, based on the command line
+    @options.
+    """
+    job_option = dict(options)
+    for key in ('input', 'output', 'xslt'):
+        if key in job:
+            job_option[key] = job[key]
+    # Each job needs its own intermediate fo file
+    job_option['fop'] = job.get('fop',
+                                os.path.splitext(job_option['output'])[0] +
+                                '.fo')
+    params = job.get('params') or {}
+    for key, param in (('invoice', 'INVOICE_NO'), ('date', 'DATE')):
+        value = params.get(param, options[key])
+        job_option[key] = str(value) if value is not None else None
+    # All other parameters are passed to the stylesheet as they are
+    job_option['params'] = dict((name, str(value)) for name, value in
+                                params.items()
+                                if name not in ('INVOICE_NO', 'DATE'))
+    return job_option
+
 
+def build_batch(options, revision=None):
+    """
+    Builds all jobs from the batch file, using options['jobs'] parallel
+    builds, and prints a status table.
+    Returns True if all jobs were built successfully.
+    """
+    jobs = [job_options(options, job) for job in read_batch(options['batch'])]
+    if options['jobs'] > 1 and len(jobs) > 1:
+        for job in jobs:
+            job['jobs'] = 1  # don't multiply the number of parallel renders
+
+    def timed_build(job):  # pylint: disable=missing-docstring
+        start = time.time()
+        return build(job, revision), time.time() - start
+
+    if options['jobs'] > 1 and len(jobs) > 1:
+        pool = ThreadPool(min(options['jobs'], len(jobs)))
+        try:
+            results = pool.map(timed_build, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [timed_build(job) for job in jobs]
+    print('[*] Batch results:')
+    print('    {0:<7} {1:>8}  {2}'.format('status', 'seconds', 'output'))
+    for job, (result, duration) in zip(jobs, results):
+        print('    {0:<7} {1:>8.1f}  {2}'.format(result and 'OK' or 'FAILED',
+                                                 duration, job['output']))
+    return all(result for result, _duration in results)
+
+
+def main():
+    """
+    The main program.
+    """
+    global verboseerror
+    global verboseprint
+    start = time.time()
+    with profiled('arguments'):
+        options = parse_arguments()
+    if options['serve']:
+        sys.exit(serve(options))
+    revision = git_revision(options)
+    if options['batch']:
+        result = build_batch(options, revision)
     else:
-        print_exit('[-] Unsuccessful (error {0})'.format(result), result)
+        result = build(options, revision)
+        if not result:
+            print('[-] Unsuccessful', file=sys.stderr)
+    write_profile(options, time.time() - start)
     sys.exit(not result)
 
 
@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+
+"""
+Dispatches independent build jobs over several docbuilder boxes.
+
+Requires Python 3, as it uses asyncio. docbuilder_proxy.py only imports this
+module for its dispatch command.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+"""
+
+import asyncio
+import os
+import shlex
+import sys
+import time
+
+import proxy_vagrant
+
+
+# Prefix of stand-in hosts, which build on this machine in the directory
+# following the prefix (or the current directory)
+LOCAL = 'local:'
+SSH_FAILED = 255  # exit code of ssh when the connection failed
+# Options and default of docbuilder.py, to give each job its own fo file
+FOP_OPTIONS = ['-f', '--fop']
+OUTPUT_OPTIONS = ['-o', '--output']
+DEFAULT_OUTPUT = '../target/report-latest.pdf'
+
+
+class Host(object):
+    """
+    A box that builds at most @concurrency jobs at the same time.
+    """
+    def __init__(self, name, concurrency):
+        self.name = name
+        self.concurrency = concurrency
+        self.active = 0
+        self.healthy = True
+        self.config_file = None
+
+    def is_local(self):
+        """
+        Returns True if this is a stand-in host.
+        """
+        return self.name.startswith(LOCAL)
+
+
+def prepare_hosts(hosts):
+    """
+    Makes sure that all Vagrant boxes run and have an ssh configuration, and
+    opens a shared connection to each of them.
+    Boxes that can't be reached are marked as unhealthy.
+    """
+    for host in hosts:
+        if host.is_local():
+            continue
+        host.config_file = proxy_vagrant.ssh_config_file(host.name)
+        if proxy_vagrant.vagrant_connection(host.name, host.config_file):
+            proxy_vagrant.open_connection(host.config_file, host.name)
+        else:
+            print('[-] Could not connect to Vagrant instance of {0}'.
+                  format(host.name), file=sys.stderr)
+            host.healthy = False
+
+
+def option_value(arguments, names):
+    """
+    Returns the value of the last option in @arguments with one of @names, or
+    None if the option isn't given.
+    """
+    value = None
+    for number, argument in enumerate(arguments):
+        for name in names:
+            if argument == name and number + 1 < len(arguments):
+                value = arguments[number + 1]
+            elif argument.startswith(name + '='):
+                value = argument[len(name) + 1:]
+            elif len(name) == 2 and argument.startswith(name) and \
+                    not argument.startswith('--') and len(argument) > 2:
+                value = argument[2:]
+    return value
+
+
+def job_arguments(job):
+    """
+    Returns the arguments of @job with its own fo file, and that fo file.
+    Concurrent jobs would otherwise all write the default fo file, so the fo
+    file is derived from the output file when it isn't given, like
+    docbuilder.py does for batch jobs.
+    """
+    arguments = shlex.split(job)
+    fo_file = option_value(arguments, FOP_OPTIONS)
+    if fo_file is None:
+        output = option_value(arguments, OUTPUT_OPTIONS) or DEFAULT_OUTPUT
+        fo_file = os.path.splitext(output)[0] + '.fo'
+        job = '{0} -f {1}'.format(job, shlex.quote(fo_file)).strip()
+    return job, fo_file
+
+
+async def acquire_host(hosts, available, tried):
+    """
+    Waits until a healthy host that wasn't @tried before has room for a job,
+    and returns the least loaded one.
+    Returns None when no such host is left.
+    """
+    async with available:
+        while True:
+            candidates = [host for host in hosts
+                          if host.healthy and host not in tried]
+            if not candidates:
+                return None
+            free = [host for host in candidates
+                    if host.active < host.concurrency]
+            if free:
+                host = min(free, key=lambda host: host.active /
+                           float(host.concurrency))
+                host.active += 1
+                return host
+            await available.wait()
+
+
+async def release_host(host, available):
+    """
+    Frees the slot of a job on @host.
+    """
+    async with available:
+        host.active -= 1
+        available.notify_all()
+
+
+async def run_job(host, command):
+    """
+    Executes @command on @host.
+    Returns the exit code and the (combined) output.
+    """
+    if host.is_local():
+        process = await asyncio.create_subprocess_shell(
+            command, cwd=host.name[len(LOCAL):] or None,
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT)
+    else:
+        process = await asyncio.create_subprocess_exec(
+            *proxy_vagrant.ssh_command(host.config_file, host.name, command),
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT)
+    output, _ = await process.communicate()
+    return process.returncode, output.decode('utf-8', 'replace')
+
+
+async def reachable(host):
+    """
+    Returns True if a command can be executed on @host. This tells apart ssh
+    failing to connect from the build itself exiting with SSH_FAILED.
+    """
+    try:
+        process = await asyncio.create_subprocess_exec(
+            *proxy_vagrant.ssh_command(host.config_file, host.name, 'true'),
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.DEVNULL)
+        return await process.wait() == 0
+    except OSError:
+        return False
+
+
+async def dispatch_job(number, command, hosts, available):
+    """
+    Builds job @number on the least loaded host, and on another host when
+    the host can't be reached.
+    Returns the result, the name of the host and the duration of the job.
+    """
+    tried = set()
+    start = time.time()
+    while True:
+        host = await acquire_host(hosts, available, tried)
+        if host is None:
+            print('[-] Job {0}: no hosts left'.format(number), file=sys.stderr)
+            return False, '', time.time() - start
+        tried.add(host)
+        try:
+            returncode, output = await run_job(host, command)
+            unreachable = returncode == SSH_FAILED and \
+                not host.is_local() and not await reachable(host)
+        except OSError as exception:
+            returncode, output = None, '[-] {0}'.format(exception)
+            unreachable = True
+        finally:
+            await release_host(host, available)
+        print('[*] Job {0} on {1}: {2}'.format(number, host.name, command))
+        if output:
+            print(output.rstrip())
+        sys.stdout.flush()
+        if unreachable:
+            print('[-] {0} is unreachable, retrying elsewhere'.
+                  format(host.name), file=sys.stderr)
+            host.healthy = False
+            continue
+        return returncode == 0, host.name, time.time() - start
+
+
+async def dispatch_all(commands, hosts):
+    """
+    Builds all @commands concurrently over @hosts.
+    Returns a list of (result, host, duration) tuples in the same order.
+    """
+    available = asyncio.Condition()
+    return await asyncio.gather(*[dispatch_job(number, command, hosts,
+                                               available)
+                                  for number, command in
+                                  enumerate(commands, 1)])
+
+
+def dispatch(hostnames, command, jobs, concurrency=1, host_concurrency=None):
+    """
+    Executes @command with the arguments of each of @jobs, spread over
+    @hostnames, and prints a status table. Each job gets its own fo file, and
+    jobs that would share one aren't started. Each host runs at most the number
+    of jobs given for it in @host_concurrency, or else @concurrency jobs.
+    Returns 0 if all jobs were built successfully, 1 otherwise.
+    """
+    arguments = []
+    jobs_per_fo_file = {}
+    for job in jobs:
+        job_argument, fo_file = job_arguments(job)
+        arguments.append(job_argument)
+        jobs_per_fo_file.setdefault(os.path.normpath(fo_file), []).append(job)
+    shared = [(fo_file, shared_jobs) for fo_file, shared_jobs in
+              sorted(jobs_per_fo_file.items()) if len(shared_jobs) > 1]
+    for fo_file, shared_jobs in shared:
+        print('[-] Jobs {0} would all write {1}, use -f to give each job its '
+              'own fo file'.format(', '.join(repr(job) for job in
+                                              shared_jobs), fo_file),
+              file=sys.stderr)
+    if shared:
+        return 1
+    host_concurrency = host_concurrency or {}
+    hosts = [Host(name, host_concurrency.get(name, concurrency))
+             for name in hostnames]
+    prepare_hosts(hosts)
+    commands = ['{0} {1}'.format(command, job) for job in arguments]
+    results = asyncio.run(dispatch_all(commands, hosts))
+    print('[*] Dispatch results:')
+    print('    {0:<7} {1:>8}  {2:<16} {3}'.format('status', 'seconds', 'host',
+                                                  'job'))
+    for job, (result, hostname, duration) in zip(jobs, results):
+        print('    {0:<7} {1:>8.1f}  {2:<16} {3}'.format(
+            result and 'OK' or 'FAILED', duration, hostname, job))
+    return 0 if all(result for result, _host, _duration in results) else 1
@@ -119,6 +119,65 @@ def read_config(filename):
     return host, command
 
 
+def read_setting(filename, key):
+    """
+    Reads optional parameter @key from configuration file.
+    Returns None if the parameter isn't set.
+    """
+    values = read_settings(filename, key)
+    if not values:
+        return None
+    return values[0]
+
+
+def read_settings(filename, key):
+    """
+    Reads all values of parameter @key, which can occur more than once, from
+    configuration file.
+    """
+    try:
+        with open(filename, 'r') as config_file:
+            values = re.findall(r'^{0}:\s?(.*)'.format(key),
+                                config_file.read(), re.MULTILINE)
+    except IOError:
+        return []
+    return [value.strip() for value in values if value.strip()]
+
+
+def dispatch(jobs):
+    """
+    Builds @jobs (or the jobs from the configuration file) over all hosts of
+    the configuration file, and exits with the result.
+    """
+    if sys.version_info < (3, 7):
+        print_error('Dispatching jobs requires Python 3.7 or newer', -1)
+    import docbuilder_dispatch  # pylint: disable=import-outside-toplevel
+    _hostname, command = read_config(CONFIG_FILE)
+    hosts = read_settings(CONFIG_FILE, 'host')
+    jobs = jobs or read_settings(CONFIG_FILE, 'job')
+    if not jobs:
+        print_error('No jobs to dispatch', -1)
+    # concurrency: NUMBER sets the default, concurrency: HOST NUMBER the
+    # concurrency of one host
+    concurrency = 1
+    host_concurrency = {}
+    for value in read_settings(CONFIG_FILE, 'concurrency'):
+        parts = value.rsplit(None, 1)
+        try:
+            number = int(parts[-1])
+            if number < 1:
+                raise ValueError
+        except ValueError:
+            print_error('concurrency {0} in {1} is not a positive number'.
+                        format(value, CONFIG_FILE), -1)
+        if len(parts) == 1:
+            concurrency = number
+        else:
+            host_concurrency[parts[0]] = number
+    sys.exit(docbuilder_dispatch.dispatch(hosts, command, jobs, concurrency,
+                                          host_concurrency))
+
+
 def main():
     """
     Executes COMMAND on BOX.
@@ -129,10 +188,15 @@ def main():
         if len(options) > 1:
             hostname = sys.argv[2]
         preflight_checks(hostname)
+    if len(options) >= 1 and sys.argv[1] == 'dispatch':
+        dispatch(options[1:])
     hostname, command = read_config(CONFIG_FILE)
+    sync = read_setting(CONFIG_FILE, 'sync')
     if len(options):
         command = '{0} {1}'.format(command, ' '.join(options))
     try:
+        if sync:
+            sys.exit(proxy_vagrant.execute_synced(hostname, command, sync))
         sys.exit(proxy_vagrant.execute_command(hostname, command))
     except OSError as exception:
         print_error('[-] Could not open file: {0}'.
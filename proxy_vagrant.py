@@ -13,14 +13,60 @@ the Free Software Foundation, either version 3 of the License, or
 from __future__ import absolute_import
 from __future__ import print_function
 
+import hashlib
+import io
+import json
 import os
 import re
 import subprocess
 from subprocess import PIPE
 import sys
+import tarfile
+import threading
+import time
 
 STATES = ['poweroff', 'aborted', 'saved']
 ACTIONS = ['up', 'resume', 'reload']
+# Per-user directory for shared connections and the status cache, only
+# accessible by the user, within XDG_RUNTIME_DIR or else within ~/.ssh
+USER_DIR = 'proxy_vagrant'
+# Shared SSH connections, closed automatically after being idle for a while
+CONTROL_PATH = 'ssh-%C'  # within USER_DIR
+CONTROL_PERSIST = '10m'
+# Vagrant's own index of all machines, relative to VAGRANT_HOME
+MACHINE_INDEX = os.path.join('data', 'machine-index', 'index')
+# Recently queried status of each box, so that global-status isn't run often
+STATUS_CACHE = 'status.json'  # within USER_DIR
+STATUS_TTL = 60  # seconds
+OUTPUT_LOCK = threading.Lock()  # keeps lines of standard out and error whole
+# Sync mode: local directories that aren't copied to the box
+SYNC_EXCLUDE = ['.git', '.vagrant', 'target']
+SYNC_MANIFEST = '.proxy_vagrant-sync.json'  # synced files, on the box
+SYNC_STAMP = '.proxy_vagrant-stamp'  # PDFs newer than this are fetched back
+SYNC_REMOVED = '.proxy_vagrant-removed'  # files to remove, NUL separated
+SHORTTAG_LENGTH = 7  # length of the revision passed to synced builds
+CHUNK_SIZE = 1024 * 1024  # bytes read at once when hashing files
+# Lists the hashes of all files in a directory on the box, and the files that
+# were synced the previous time. Runs on Python 2 and 3.
+REMOTE_HASHES = '''
+import hashlib, json, os, sys
+root = sys.argv[1]
+files = {}
+for directory, directories, names in os.walk(root):
+    directories[:] = [name for name in directories if name != '.git']
+    for name in names:
+        path = os.path.join(directory, name)
+        digest = hashlib.sha1()
+        with open(path, 'rb') as data:
+            for chunk in iter(lambda: data.read(1048576), b''):
+                digest.update(chunk)
+        files[os.path.relpath(path, root)] = digest.hexdigest()
+try:
+    synced = json.load(open(os.path.join(root, sys.argv[2])))
+except (IOError, ValueError):
+    synced = []
+print(json.dumps({'files': files, 'synced': synced}))
+'''
 
 
 def command_fails(cmd):
@@ -52,12 +98,20 @@ def connect_vagrant(hostname, rerun=False):
     """
     print('[*] Querying status of {0}... '.format(hostname), end='')
     sys.stdout.flush()
-    result, vagrant_id = start_vagrant(hostname)
+    result, vagrant_id = start_vagrant(hostname, cached=not rerun)
     if not result:
         print_exit('[-] Could not start Vagrant box {0}'.format(hostname), -5)
     print('[*] Trying to connect to {0}... '.format(hostname), end='')
     sys.stdout.flush()
-    result = command_fails(['vagrant', 'ssh', vagrant_id, '-c', 'id'])
+    config_file = ssh_config_file(hostname)
+    if rerun:
+        close_connection(config_file, hostname)
+    if (os.path.isfile(config_file) and not rerun) or \
+       write_ssh_config(vagrant_id, config_file):
+        open_connection(config_file, hostname)
+        result = command_fails(ssh_command(config_file, hostname, 'id'))
+    else:
+        result = command_fails(['vagrant', 'ssh', vagrant_id, '-c', 'id'])
     if result:
         if rerun:
             print_exit('[-] Failed', -6)
@@ -65,11 +119,12 @@ def connect_vagrant(hostname, rerun=False):
         connect_vagrant(hostname, True)
 
 
-def start_vagrant(hostname, action=0):
+def start_vagrant(hostname, action=0, cached=True):
     """
     Tries really hard to start a Vagrant instance.
+    If not @cached, then always ask Vagrant for the status.
     """
-    vagrant_id, status = vagrant_status(hostname)
+    vagrant_id, status = vagrant_status(hostname, cached)
     if not action:
         print(status)
 #    if 'running' in status:
@@ -84,19 +139,30 @@ def start_vagrant(hostname, action=0):
         print('[*] Not giving up, trying to {0} Vagrant box... '.
               format(command), end='')
         sys.stdout.flush()
-        if command_fails(['vagrant', command, vagrant_id]):
+        failed = command_fails(['vagrant', command, vagrant_id])
+        invalidate_status(hostname)
+        if failed:
             start_vagrant(hostname, action + 1)
     return True, vagrant_id
 
 
-def vagrant_status(hostname):
+def vagrant_status(hostname, cached=True):
     """
     Returns global ID and status of hostname.
+    If @cached, then the machine index of Vagrant or a recently queried
+    status are used, instead of asking Vagrant.
 
     Arguments:
     - `hostname`: hostname of Vagrant box
     """
     # pylint: disable=unused-variable
+    if cached:
+        vagrant_id, status = indexed_status(hostname)
+        if vagrant_id:
+            return vagrant_id, status
+        entry = read_status_cache().get(hostname)
+        if entry and time.time() - entry['time'] < STATUS_TTL:
+            return entry['id'], entry['status']
     status = 'unknown'
     vagrant_id = ''
     cmd = ['vagrant', 'global-status']
@@ -105,15 +171,77 @@ def vagrant_status(hostname):
         stdout, _stderr = process.communicate()
         if not process.returncode and stdout:
             line = re.findall(r'([0-9a-f]*)\s+{0}\s+virtualbox\s+(\w+)\s'.
-                              format(hostname), stdout)
+                              format(re.escape(hostname)),
+                              stdout.decode('utf-8', 'replace'))
             if line:
                 vagrant_id, status = line[0]
+                write_status_cache(hostname, vagrant_id, status)
     except OSError as exception:
         print_exit('[-] Could not find vagrant executable: {0}'.
                    format(exception.strerror), exception.errno)
     return vagrant_id, status
 
 
+def indexed_status(hostname):
+    """
+    Returns global ID and status of hostname from the machine index of
+    Vagrant, or empty strings when the index can't be read.
+    """
+    vagrant_home = os.environ.get('VAGRANT_HOME',
+                                  os.path.join(os.path.expanduser('~'),
+                                               '.vagrant.d'))
+    try:
+        with open(os.path.join(vagrant_home, MACHINE_INDEX)) as index_file:
+            machines = json.load(index_file).get('machines', {})
+    except (IOError, ValueError, AttributeError):
+        return '', ''
+    for uuid, machine in machines.items():
+        if machine.get('name') == hostname and \
+           machine.get('provider') == 'virtualbox' and machine.get('state'):
+            # global-status shows the first 7 characters as global ID
+            return uuid[:7], machine['state']
+    return '', ''
+
+
+def read_status_cache():
+    """
+    Returns the recently queried status of all boxes.
+    """
+    try:
+        with open(os.path.join(user_dir(), STATUS_CACHE)) as cache_file:
+            return json.load(cache_file)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def write_status_cache(hostname, vagrant_id, status):
+    """
+    Stores the status of @hostname in the status cache.
+    """
+    cache = read_status_cache()
+    cache[hostname] = {'id': vagrant_id, 'status': status, 'time': time.time()}
+    try:
+        with open(os.path.join(user_dir(), STATUS_CACHE), 'w') as cache_file:
+            json.dump(cache, cache_file)
+    except (IOError, OSError):
+        pass
+
+
+def invalidate_status(hostname):
+    """
+    Removes the status of @hostname from the status cache, after its status
+    was changed.
+    """
+    cache = read_status_cache()
+    if cache.pop(hostname, None) is not None:
+        try:
+            with open(os.path.join(user_dir(), STATUS_CACHE),
+                      'w') as cache_file:
+                json.dump(cache, cache_file)
+        except (IOError, OSError):
+            pass
+
+
 def vagrant_connection(hostname, filename, force=False):
     """
     Obtains a ssh configuration file from the global Vagrant store.
@@ -122,51 +250,167 @@ def vagrant_connection(hostname, filename, force=False):
     # pylint: disable=unused-variable
     if not force and os.path.isfile(filename):
         return True
+    # The shared connection may use outdated settings
+    close_connection(filename, hostname)
     result = False
     result, vagrant_id = start_vagrant(hostname)
     if result:
-        try:
-            cmd = ['vagrant', 'ssh-config', vagrant_id]
-            process = subprocess.Popen(cmd, stdout=PIPE, stderr=PIPE)
-            stdout, _stderr = process.communicate()
-            if not process.returncode:
-                with open(filename, 'w') as config_file:
-                    config_file.write(stdout)
-                    result = True
-        except OSError as exception:
-            print_exit('[-] Could not find vagrant executable: {0}'.
-                       format(exception.strerror), exception.errno)
+        result = write_ssh_config(vagrant_id, filename)
+    return result
+
+
+def write_ssh_config(vagrant_id, filename):
+    """
+    Writes the ssh configuration of Vagrant box @vagrant_id to @filename.
+    Returns True if successful.
+    """
+    # pylint: disable=unused-variable
+    result = False
+    try:
+        cmd = ['vagrant', 'ssh-config', vagrant_id]
+        process = subprocess.Popen(cmd, stdout=PIPE, stderr=PIPE)
+        stdout, _stderr = process.communicate()
+        if not process.returncode:
+            with open(filename, 'wb') as config_file:
+                config_file.write(stdout)
+                result = True
+    except OSError as exception:
+        print_exit('[-] Could not find vagrant executable: {0}'.
+                   format(exception.strerror), exception.errno)
     return result
 
 
+def ssh_config_file(hostname):
+    """
+    Returns the name of the cached SSH configuration file of @hostname.
+    """
+    return hostname + '.ssh-config'
+
+
+def user_dir():
+    """
+    Returns the per-user directory USER_DIR, and creates it when needed.
+    Only the user has access to it, unlike the shared temporary directory.
+    Raises OSError when the directory can't be created.
+    """
+    base = os.getenv('XDG_RUNTIME_DIR') or \
+        os.path.join(os.path.expanduser('~'), '.ssh')
+    directory = os.path.join(base, USER_DIR)
+    try:
+        os.makedirs(directory, 0o700)
+    except OSError:
+        if not os.path.isdir(directory):
+            raise
+    if sys.platform != 'win32' and os.stat(directory).st_mode & 0o077:
+        os.chmod(directory, 0o700)
+    return directory
+
+
+def ssh_options():
+    """
+    Returns the SSH options that use the shared connection, if there is one.
+    Windows' OpenSSH doesn't support connection sharing.
+    """
+    if sys.platform == 'win32':
+        return []
+    try:
+        control_path = os.path.join(user_dir(), CONTROL_PATH)
+    except OSError:
+        return []
+    return ['-o', 'ControlPath={0}'.format(control_path)]
+
+
+def ssh_command(config_file, hostname, command):
+    """
+    Returns the command line to execute @command on @hostname using the SSH
+    configuration @config_file and the shared connection.
+    """
+    options = ssh_options()
+    if options:
+        options += ['-o', 'ControlMaster=no']
+    return ['ssh', '-F', config_file] + options + [hostname, command]
+
+
+def control_command(config_file, hostname, command):
+    """
+    Sends @command (check or exit) to the shared connection to @hostname.
+    Returns True if successful.
+    """
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return not subprocess.call(['ssh', '-F', config_file] +
+                                       ssh_options() +
+                                       ['-O', command, hostname],
+                                       stdout=devnull, stderr=devnull)
+    except OSError:
+        return False
+
+
+def open_connection(config_file, hostname):
+    """
+    Opens a shared SSH connection to @hostname in the background, if there
+    isn't one yet. The connection closes itself after CONTROL_PERSIST of
+    inactivity.
+    """
+    if not ssh_options() or control_command(config_file, hostname, 'check'):
+        return
+    # The master doesn't inherit any pipes, so that it can't block readers
+    try:
+        with open(os.devnull, 'w') as devnull:
+            subprocess.call(['ssh', '-F', config_file] + ssh_options() +
+                            ['-o', 'ControlMaster=yes',
+                             '-o', 'ControlPersist={0}'.format(CONTROL_PERSIST),
+                             '-f', '-N', hostname],
+                            stdout=devnull, stderr=devnull)
+    except OSError:
+        pass
+
+
+def close_connection(config_file, hostname):
+    """
+    Closes the shared SSH connection to @hostname, if there is one.
+    """
+    if ssh_options() and os.path.isfile(config_file):
+        control_command(config_file, hostname, 'exit')
+
+
 def execute_ssh(config_file, hostname, command):
     """
     Executes @command on @hostname using the SSH configuration @config_file.
     """
-    cmd = ['ssh', '-F', config_file, hostname, command]
+    open_connection(config_file, hostname)
+    cmd = ssh_command(config_file, hostname, command)
     process = subprocess.Popen(cmd, stdout=PIPE, stderr=PIPE)
-    stdout, stderr = process.communicate()
-    print_stdoutput(stdout, stderr)
+    # Pipes can't be polled on Windows, so each one gets a thread
+    threads = [threading.Thread(target=forward_lines, args=(stream, output))
+               for stream, output in ((process.stdout, sys.stdout),
+                                      (process.stderr, sys.stderr))]
+    for thread in threads:
+        thread.start()
+    process.wait()
+    for thread in threads:
+        thread.join()
     return process.returncode
 
 
-def print_exit(text, result):
+def forward_lines(stream, output):
     """
-    Prints error message and exits with result code.
+    Shows the lines of @stream on @output as they arrive, until @stream is
+    closed.
     """
-    print('[-] ' + text, file=sys.stderr)
-    sys.exit(result)
+    output = getattr(output, 'buffer', output)  # bytes on Python 3
+    for line in iter(stream.readline, b''):
+        with OUTPUT_LOCK:
+            output.write(line)
+            output.flush()
 
 
-def print_stdoutput(stdout, stderr):
+def print_exit(text, result):
     """
-    Prints out standard out and standard err using the verboseprint function.
+    Prints error message and exits with result code.
     """
-    if stdout:
-        print(stdout.strip())
-        sys.stdout.flush()
-    if stderr:
-        print_error(stderr.strip())
+    print('[-] ' + text, file=sys.stderr)
+    sys.exit(result)
 
 
 def print_error(text):
@@ -177,12 +421,171 @@ def print_error(text):
     sys.stderr.flush()
 
 
+def quote(text):
+    """
+    Returns @text quoted for the shell on the box.
+    """
+    return "'" + text.replace("'", "'\\''") + "'"
+
+
+def local_hashes(directory):
+    """
+    Returns the SHA1 hash of all files in @directory, except SYNC_EXCLUDE,
+    keyed by their path relative to @directory (with forward slashes).
+    """
+    hashes = {}
+    for root, directories, names in os.walk(directory):
+        directories[:] = [name for name in directories
+                          if name not in SYNC_EXCLUDE]
+        for name in names:
+            path = os.path.join(root, name)
+            digest = hashlib.sha1()
+            with open(path, 'rb') as data:
+                for chunk in iter(lambda: data.read(CHUNK_SIZE), b''):
+                    digest.update(chunk)
+            hashes[os.path.relpath(path, directory).replace(os.sep, '/')] = \
+                digest.hexdigest()
+    return hashes
+
+
+def remote_hashes(config_file, hostname, remote_dir):
+    """
+    Returns the hashes of all files in @remote_dir on @hostname, and the list
+    of files that were synced the previous time.
+    """
+    cmd = ssh_command(config_file, hostname,
+                      'mkdir -p {0} && python - {0} {1}'.
+                      format(quote(remote_dir), SYNC_MANIFEST))
+    process = subprocess.Popen(cmd, stdin=PIPE, stdout=PIPE, stderr=PIPE)
+    stdout, stderr = process.communicate(REMOTE_HASHES.encode('utf-8'))
+    if process.returncode:
+        print_error(stderr.decode('utf-8', 'replace').strip())
+        return None, None
+    listing = json.loads(stdout.decode('utf-8'))
+    return listing['files'], listing['synced']
+
+
+def sync_files(config_file, hostname, remote_dir):
+    """
+    Copies the files of the current directory that changed since the previous
+    sync to @remote_dir on @hostname, and removes files that were synced
+    before but don't exist anymore.
+    Returns True if successful.
+    """
+    local = local_hashes('.')
+    remote, synced = remote_hashes(config_file, hostname, remote_dir)
+    if remote is None:
+        return False
+    changed = sorted(name for name in local if remote.get(name) != local[name])
+    removed = sorted(name for name in synced if name not in local and
+                     name in remote)
+    print('[*] Syncing {0} changed and {1} removed files to {2}:{3}'.
+          format(len(changed), len(removed), hostname, remote_dir))
+    sys.stdout.flush()
+    # The names of removed files are sent within the archive, as there may be
+    # too many of them for one command line
+    command = 'cd {0} && tar xf - && touch {1} && xargs -0 rm -f -- < {2}'.\
+        format(quote(remote_dir), SYNC_STAMP, SYNC_REMOVED)
+    process = subprocess.Popen(ssh_command(config_file, hostname, command),
+                               stdin=PIPE)
+    try:
+        with tarfile.open(fileobj=process.stdin, mode='w|') as archive:
+            for name in changed:
+                archive.add(name)
+            for name, contents in (
+                    (SYNC_MANIFEST, json.dumps(sorted(local)).encode('utf-8')),
+                    (SYNC_REMOVED, b''.join(name.encode('utf-8') + b'\0'
+                                            for name in removed))):
+                info = tarfile.TarInfo(name)
+                info.size = len(contents)
+                info.mtime = time.time()
+                archive.addfile(info, io.BytesIO(contents))
+    except (IOError, OSError) as exception:
+        print_error('[-] Could not sync files: {0}'.format(exception))
+    finally:
+        process.stdin.close()
+    return not process.wait()
+
+
+def fetch_pdfs(config_file, hostname, remote_dir):
+    """
+    Copies all PDF files that were created on @hostname in @remote_dir since
+    the sync back to the current directory.
+    Returns True if successful.
+    """
+    command = 'cd {0} && find . -name \'*.pdf\' -type f -newer {1} | ' \
+              'tar cf - -T -'.format(quote(remote_dir), SYNC_STAMP)
+    process = subprocess.Popen(ssh_command(config_file, hostname, command),
+                               stdout=PIPE)
+    try:
+        with tarfile.open(fileobj=process.stdout, mode='r|') as archive:
+            for member in archive:
+                name = os.path.normpath(member.name)
+                if not member.isfile() or os.path.isabs(name) or \
+                   name.startswith(os.pardir):
+                    continue
+                if os.path.dirname(name) and \
+                   not os.path.isdir(os.path.dirname(name)):
+                    os.makedirs(os.path.dirname(name))
+                with open(name, 'wb') as pdf:
+                    pdf.write(archive.extractfile(member).read())
+                print('[+] Fetched {0}'.format(name))
+    except (IOError, OSError, tarfile.TarError) as exception:
+        print_error('[-] Could not fetch PDF files: {0}'.format(exception))
+    finally:
+        process.stdout.close()
+    return not process.wait()
+
+
+def git_revision():
+    """
+    Returns the abbreviated commit hash of the current directory, or None if
+    it isn't part of a git repository.
+    """
+    try:
+        process = subprocess.Popen(['git', 'rev-parse',
+                                    '--short={0}'.format(SHORTTAG_LENGTH),
+                                    'HEAD'], stdout=PIPE, stderr=PIPE)
+        stdout, _stderr = process.communicate()
+    except OSError:
+        return None
+    if process.returncode:
+        return None
+    return stdout.decode('utf-8').strip() or None
+
+
+def execute_synced(hostname, command, remote_dir, force=False):
+    """
+    Syncs the current directory to @remote_dir on Vagrant box @hostname,
+    executes @command there, and fetches back the PDF files it created.
+    This avoids slow shared folders for the build itself. As .git isn't
+    synced, the git revision is passed to @command using --revision.
+    If @force, then overwrite cached SSH file.
+    """
+    config_file = ssh_config_file(hostname)
+    if not vagrant_connection(hostname, config_file, force):
+        print_error('[-] Could not connect to Vagrant instance of {0}'.
+                    format(hostname))
+    open_connection(config_file, hostname)
+    if not sync_files(config_file, hostname, remote_dir):
+        print_error('[-] Could not sync files to {0}'.format(hostname))
+        return -1
+    revision = git_revision()
+    if revision and '--revision' not in command:
+        command = '{0} --revision {1}'.format(command, quote(revision))
+    result = execute_ssh(config_file, hostname, 'cd {0} && {1}'.
+                         format(quote(remote_dir), command))
+    if not fetch_pdfs(config_file, hostname, remote_dir) and not result:
+        result = -1
+    return result
+
+
 def execute_command(hostname, command, force=False):
     """
     Executes @command using ssh on Vagrant box @hostname.
     If @force, then overwrite cached SSH file.
     """
-    config_file = hostname + '.ssh-config'
+    config_file = ssh_config_file(hostname)
     if not vagrant_connection(hostname, config_file, force):
         print_error('[-] Could not connect to Vagrant instance of {0}'.
                     format(hostname))
@@ -14,7 +14,7 @@
 # File which has to be available in target directory to qualify as target
 FINGERPRINT="docbuilder.py"
 # List of files and directories that need to be updated
-SOURCEFILES="docbuilder.py docbuilder_proxy.py proxy_vagrant.py show validate_report.py"
+SOURCEFILES="docbuilder.py docbuilder_dispatch.py docbuilder_proxy.py proxy_vagrant.py show validate_report.py"
 # Root directory within source repo
 SOURCEROOT=""
 
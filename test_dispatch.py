@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+
+"""
+Tests docbuilder_dispatch by dispatching jobs to local: hosts, which run the
+command on this machine.
+
+Run with python3 -m unittest test_dispatch
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+"""
+
+import asyncio
+import contextlib
+import io
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import docbuilder_dispatch
+from docbuilder_dispatch import LOCAL, SSH_FAILED
+
+
+# Stands in for docbuilder.py: creates the output file (after -o) of a job
+# in the directory of the host it runs on
+BUILD = 'sh -c \'touch "$2"\' build'
+
+
+class DispatchTest(unittest.TestCase):
+    """
+    Dispatches jobs to local: hosts.
+    """
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.hosts = []
+        for name in ('one', 'two'):
+            path = os.path.join(self.directory, name)
+            os.mkdir(path)
+            self.hosts.append(LOCAL + path)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def dispatch(self, hostnames, command, jobs, *arguments):
+        """
+        Dispatches @jobs without showing the output.
+        Returns the exit code.
+        """
+        with contextlib.redirect_stdout(io.StringIO()), \
+                contextlib.redirect_stderr(io.StringIO()):
+            return docbuilder_dispatch.dispatch(hostnames, command, jobs,
+                                                *arguments)
+
+    def built(self):
+        """
+        Returns the names of the jobs that were built, per host directory.
+        """
+        return dict((name, sorted(os.listdir(os.path.join(self.directory,
+                                                          name))))
+                    for name in ('one', 'two'))
+
+    def test_all_jobs_built(self):
+        outputs = ['job{0}.pdf'.format(number) for number in range(6)]
+        jobs = ['-o ' + output for output in outputs]
+        self.assertEqual(self.dispatch(self.hosts, BUILD, jobs, 2), 0)
+        built = self.built()
+        self.assertEqual(sorted(built['one'] + built['two']), outputs)
+        self.assertTrue(built['one'] and built['two'])
+
+    def test_failing_host(self):
+        missing = LOCAL + os.path.join(self.directory, 'missing')
+        outputs = ['job{0}.pdf'.format(number) for number in range(4)]
+        jobs = ['-o ' + output for output in outputs]
+        self.assertEqual(self.dispatch([missing, self.hosts[0]], BUILD,
+                                       jobs), 0)
+        self.assertEqual(self.built()['one'], outputs)
+
+    def test_failing_job(self):
+        self.assertEqual(self.dispatch(self.hosts[:1], 'touch built && false',
+                                       ['failed']), 1)
+        self.assertEqual(self.built()['one'], ['built'])
+
+    def test_no_hosts_left(self):
+        missing = LOCAL + os.path.join(self.directory, 'missing')
+        self.assertEqual(self.dispatch([missing], BUILD, ['-o job.pdf']), 1)
+
+    def test_own_fo_file(self):
+        self.assertEqual(docbuilder_dispatch.job_arguments(
+            '-c -o ../target/offerte-latest.pdf'),
+                         ('-c -o ../target/offerte-latest.pdf -f '
+                          '../target/offerte-latest.fo',
+                          '../target/offerte-latest.fo'))
+        self.assertEqual(docbuilder_dispatch.job_arguments('-c --fop=a.fo'),
+                         ('-c --fop=a.fo', 'a.fo'))
+
+    def test_shared_fo_file(self):
+        # Jobs sharing an fo file aren't started
+        self.assertEqual(self.dispatch(self.hosts, BUILD,
+                                       ['-c', '-c -f '
+                                        '../target/report-latest.fo']), 1)
+        self.assertEqual(self.dispatch(self.hosts, BUILD,
+                                       ['-o a.pdf', '-o b.pdf -f a.fo']), 1)
+        self.assertEqual(self.built(), {'one': [], 'two': []})
+
+    def test_host_concurrency(self):
+        hosts = [docbuilder_dispatch.Host(self.hosts[0], 1),
+                 docbuilder_dispatch.Host(self.hosts[1], 3)]
+        peak = dict((host.name, 0) for host in hosts)
+
+        async def run_job(host, _command):
+            peak[host.name] = max(peak[host.name], host.active)
+            await asyncio.sleep(0.05)
+            return 0, ''
+
+        with mock.patch.object(docbuilder_dispatch, 'run_job', run_job), \
+                contextlib.redirect_stdout(io.StringIO()):
+            results = asyncio.run(docbuilder_dispatch.dispatch_all(
+                ['true'] * 8, hosts))
+        self.assertTrue(all(result for result, _host, _duration in results))
+        self.assertEqual(peak, {self.hosts[0]: 1, self.hosts[1]: 3})
+
+    def test_remote_exit_code(self):
+        hosts = [docbuilder_dispatch.Host('box1', 1),
+                 docbuilder_dispatch.Host('box2', 1)]
+
+        async def run_job(_host, _command):
+            await asyncio.sleep(0.05)
+            return SSH_FAILED, ''
+
+        async def reachable(host):
+            return host.name == 'box1'
+
+        with mock.patch.object(docbuilder_dispatch, 'run_job', run_job), \
+                mock.patch.object(docbuilder_dispatch, 'reachable',
+                                  reachable), \
+                contextlib.redirect_stdout(io.StringIO()), \
+                contextlib.redirect_stderr(io.StringIO()):
+            results = asyncio.run(docbuilder_dispatch.dispatch_all(
+                ['build'] * 2, hosts))
+        # A build exiting with SSH_FAILED on a reachable host isn't retried
+        self.assertEqual([(result, host) for result, host, _duration in
+                          results], [(False, 'box1'), (False, 'box1')])
+        self.assertFalse(hosts[1].healthy)
+
+
+if __name__ == '__main__':
+    unittest.main()
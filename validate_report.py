@@ -15,15 +15,25 @@ from __future__ import absolute_import
 from __future__ import print_function
 
 import argparse
-import mmap
+import contextlib
+import copy
+import hashlib
+import json
+import multiprocessing
 import os
 import re
 import subprocess
 import sys
+import tempfile
 import textwrap
-import xml.sax
+import time
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
 
 from lxml import etree as ElementTree
+from lxml import isoschematron
 
 
 # When set to True, the report will be validated using docbuilder
@@ -31,6 +41,8 @@ DOCBUILDER = False
 VOCABULARY = 'project-vocabulary.pws'
 # Snippets may contain XML fragments without the proper entities
 EXAMPLEDIR = 'examples/'
+# Keywords (regular expressions) that shouldn't occur in finished documents
+KEYWORDS = ['TODO', r'\bFIXME\b', r'\bXXX\b', r'\b[Ll]orem [Ii]psum\b']
 NOT_CAPITALIZED = ['a', 'an', 'and', 'as', 'at', 'but', 'by', 'for', 'in',
                    'nor', 'of', 'on', 'or', 'the', 'to', 'up']
 SNIPPETDIR = 'snippets/'
@@ -39,6 +51,80 @@ OFFERTE = '/offerte.xml'
 REPORT = '/report.xml'
 WARN_LINE = 100  # There should be a separation character after x characters...
 MAX_LINE = 130  # ... and before y
+PARSED = {}  # Parsed master files, so that they are only parsed once
+TEXTS = {}  # text within each element of the file being validated
+STREAM_SIZE = 20 * 1024 * 1024  # validate larger files without loading them
+CHUNK_SIZE = 1024 * 1024  # bytes read at once when hashing files
+# Document types with type specific checks, which need the complete tree
+TYPED = ['finding', 'non-finding', 'pentest_report']
+# Tags whose text isn't checked for spelling
+NOT_SPELLED = ['a', 'code', 'monospace', 'pre']
+XINCLUDE = '{http://www.w3.org/2001/XInclude}include'
+# Increase when checks change, so that cached validation results are discarded
+VALIDATOR_VERSION = 5
+CACHE_FILE = 'validate_report.cache'  # stored in the git directory
+SPELLING_CACHE = 'spelling.cache'  # known good words, in the git directory
+SPELLER = None  # one speller per process
+WORDS = {}  # spelling verdict per word
+NEW_WORDS = set()  # correctly spelled words not in the spelling cache yet
+# Options that influence the validation result of a file
+CACHED_OPTIONS = ['capitalization', 'keyword', 'long', 'spelling']
+KEYWORD_PATTERNS = {}  # compiled keyword patterns per set of keywords
+GIT_DIRS = {}  # git directory of each working directory
+ISSUES = []  # all reported issues, for machine-readable output
+TIMINGS = {}  # seconds spent per file, per check
+FORMATS = ['text', 'json', 'junit', 'sarif']
+SARIF_SCHEMA = 'https://json.schemastore.org/sarif-2.1.0.json'
+SARIF_LEVELS = ['error', 'warning', 'note', 'none']  # valid result levels
+# Compiled schema, stored in the git directory, per schema and lxml version
+SCHEMA_CACHE = 'validate_report-{0}.xsl'
+SCHEMA_VALIDATOR = None  # one compiled schema per process
+SVRL = '{http://purl.oclc.org/dsdl/svrl}'
+# Rules per document type, with the assert id as rule name.
+# {filename} is replaced by the validated file.
+# Checks that can be fixed automatically are performed by validate_type.
+SCHEMA = '''<schema xmlns="http://purl.oclc.org/dsdl/schematron">
+  <pattern id="pentest_report">
+    <rule context="/pentest_report">
+      <assert id="pentest_report-missing-findingCode" test="@findingCode" role="error">[A] Missing obligatory attribute in {filename}: findingCode</assert>
+    </rule>
+  </pattern>
+  <pattern id="finding">
+    <rule context="/finding">
+      <assert id="finding-missing-threatLevel" test="@threatLevel" role="error">[A] Missing obligatory attribute in {filename}: threatLevel</assert>
+      <assert id="finding-threat-level" test="not(@threatLevel) or @threatLevel='Low' or @threatLevel='Moderate' or @threatLevel='Elevated' or @threatLevel='High' or @threatLevel='Extreme'" role="error">[-] threatLevel is not Low, Moderate, High, Elevated or Extreme: <value-of select="@threatLevel"/></assert>
+      <assert id="finding-missing-type" test="@type" role="error">[A] Missing obligatory attribute in {filename}: type</assert>
+      <assert id="finding-missing-title" test="title" role="error">[-] Missing tag in {filename}: title</assert>
+      <assert id="finding-missing-description" test="description" role="error">[-] Missing tag in {filename}: description</assert>
+      <assert id="finding-missing-technicaldescription" test="technicaldescription" role="error">[-] Missing tag in {filename}: technicaldescription</assert>
+      <assert id="finding-missing-impact" test="impact" role="error">[-] Missing tag in {filename}: impact</assert>
+      <assert id="finding-missing-recommendation" test="recommendation" role="error">[-] Missing tag in {filename}: recommendation</assert>
+    </rule>
+    <rule context="/finding/title">
+      <assert id="finding-empty-title" test="normalize-space(.)" role="error">[-] Empty tag in {filename}: title</assert>
+    </rule>
+    <rule context="/finding/description">
+      <assert id="finding-empty-description" test="normalize-space(.)" role="error">[-] Empty tag in {filename}: description</assert>
+    </rule>
+    <rule context="/finding/technicaldescription">
+      <assert id="finding-empty-technicaldescription" test="normalize-space(.)" role="error">[-] Empty tag in {filename}: technicaldescription</assert>
+    </rule>
+    <rule context="/finding/impact">
+      <assert id="finding-empty-impact" test="normalize-space(.)" role="error">[-] Empty tag in {filename}: impact</assert>
+    </rule>
+    <rule context="/finding/recommendation">
+      <assert id="finding-empty-recommendation" test="normalize-space(.)" role="error">[-] Empty tag in {filename}: recommendation</assert>
+    </rule>
+  </pattern>
+  <pattern id="non-finding">
+    <rule context="/non-finding">
+      <assert id="non-finding-missing-title" test="title" role="error">[-] Missing tag in {filename}: title</assert>
+    </rule>
+    <rule context="/non-finding/title">
+      <assert id="non-finding-empty-title" test="normalize-space(.)" role="error">[-] Empty tag in {filename}: title</assert>
+    </rule>
+  </pattern>
+</schema>'''
 
 
 if DOCBUILDER:
@@ -47,7 +133,11 @@ if DOCBUILDER:
 try:
     import aspell
 except:
-    print('[-] aspell not installed: spelling not available')
+    print('[-] aspell not installed: spelling not available', file=sys.stderr)
+try:
+    basestring
+except NameError:  # Python 3
+    basestring = str
 
 
 def parse_arguments():
@@ -70,25 +160,135 @@ the Free Software Foundation, either version 3 of the License, or
                         help='Try to automatically correct issues')
     parser.add_argument('-c', '--capitalization', action='store_true',
                         help='Check capitalization')
+    parser.add_argument('--changed-since', action='store', metavar='REV',
+                        help='Only validate files changed since git revision REV')
     parser.add_argument('--debug', action='store_true',
                         help='Show debug information')
     parser.add_argument('--edit', action='store_true',
                         help='Open files with issues using an editor')
+    parser.add_argument('--format', action='store', choices=FORMATS,
+                        default='text',
+                        help='Output format of the issues (default text). '
+                        'Other formats are written to stdout, all messages '
+                        'to stderr')
+    parser.add_argument('-j', '--jobs', action='store', type=int, default=1,
+                        help='Number of files to validate in parallel')
+    parser.add_argument('--keyword', action='append', default=[],
+                        help='Additional keyword (regular expression) to flag, can be repeated')
     parser.add_argument('--learn', action='store_true',
                         help='Store all unknown words in dictionary file')
     parser.add_argument('--long', action='store_true',
                         help='Check for long lines')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='Validate all files, even when they were validated before')
     parser.add_argument('--offer', action='store_true',
                         help='Validate offer master file')
     parser.add_argument('--spelling', action='store_true',
                         help='Check spelling')
+    parser.add_argument('--staged', action='store_true',
+                        help='Only validate files staged for commit')
     parser.add_argument('-v', '--verbose', action='store_true',
                         help='increase output verbosity')
     parser.add_argument('--no-report', action='store_true',
                         help='Do not validate report master file')
     parser.add_argument('--quiet', action='store_true',
                         help='Don\'t output status messages')
-    return vars(parser.parse_args())
+    options = vars(parser.parse_args())
+    # Staged files are read from the index, and fixing or editing them would
+    # overwrite unstaged changes in the working tree
+    if options['staged'] and (options['auto_fix'] or options['edit']):
+        parser.error('--auto-fix and --edit can\'t be used with --staged')
+    for keyword in options['keyword']:
+        try:
+            re.compile(keyword)
+        except re.error as exception:
+            parser.error('invalid --keyword {0} ({1})'.format(keyword,
+                                                             exception))
+    return options
+
+
+def get_speller(options):
+    """
+    Returns the speller, which is created once per process.
+    """
+    global SPELLER
+    if SPELLER is None:
+        try:
+            SPELLER = aspell.Speller(('lang', 'en'),
+                                     ('personal-dir', '.'),
+                                     ('personal', VOCABULARY))
+        except:  # some versions of aspell use a different path
+            SPELLER = aspell.Speller(('lang', 'en'),
+                                     ('personal-path', './' + VOCABULARY))
+        if options['debug']:
+            [print(i[0] + ' ' + str(i[2]) + '\n') for i in SPELLER.ConfigKeys()]
+        read_spelling_cache()
+    return SPELLER
+
+
+def read_spelling_cache():
+    """
+    Reads the known good words from the spelling cache, if the cache belongs
+    to the current vocabulary file.
+    """
+    try:
+        with open(git_file(SPELLING_CACHE)) as json_file:
+            cache = json.load(json_file)
+    except (IOError, ValueError):
+        return
+    if cache.get('vocabulary') == vocabulary_id():
+        WORDS.update(dict.fromkeys(cache.get('words', []), True))
+
+
+def write_spelling_cache(options):
+    """
+    Adds all new known good words to the spelling cache.
+    """
+    if not NEW_WORDS:
+        return
+    words = [word for word, verdict in WORDS.items() if verdict]
+    try:
+        with open(git_file(SPELLING_CACHE), 'w') as json_file:
+            json.dump({'vocabulary': vocabulary_id(),
+                       'words': sorted(words)}, json_file)
+    except IOError as exception:
+        print_output(options, 'Could not write spelling cache ({0})'.
+                     format(exception))
+
+
+def vocabulary_id():
+    """
+    Returns the git blob id of the vocabulary file, or None if it's missing.
+    """
+    if os.path.isfile(VOCABULARY):
+        return blob_id(VOCABULARY)
+    return None
+
+
+def check_spelling(text, filename, options, line=None):
+    """
+    Checks the spelling of all words in @text, which starts on @line. Each
+    distinct word is only checked once per run.
+    If options['learn'], then unknown words will be added to the dictionary.
+    Returns True if all words are spelled correctly.
+    """
+    result = True
+    speller = get_speller(options)
+    for word in re.findall('([a-zA-Z]+\'?[a-zA-Z]+)', text):
+        if word not in WORDS:
+            WORDS[word] = bool(speller.check(word))
+            if WORDS[word]:
+                NEW_WORDS.add(word)
+        if not WORDS[word]:
+            if options['learn']:
+                speller.addtoPersonal(word)
+                WORDS[word] = True
+            else:
+                result = False
+                report_issue(filename, 'spelling',
+                             '[-] Misspelled (unknown) word {0} in {1}'.
+                             format(word, filename), line=line)
+    return result
 
 
 def validate_spelling(tree, filename, options):
@@ -97,43 +297,184 @@ def validate_spelling(tree, filename, options):
     If options['learn'], then unknown words will be added to the dictionary.
     """
     result = True
-    try:
-        speller = aspell.Speller(('lang', 'en'),
-                                 ('personal-dir', '.'),
-                                 ('personal', VOCABULARY))
-    except:  # some versions of aspell use a different path
-        speller = aspell.Speller(('lang', 'en'),
-                                 ('personal-path', './' + VOCABULARY))
-    if options['debug']:
-        [print(i[0] + ' ' + str(i[2]) + '\n') for i in speller.ConfigKeys()]
     try:
         root = tree.getroot()
         for section in root.iter():
             if section.text and isinstance(section.tag, basestring) and \
-               section.tag not in ('a', 'code', 'monospace', 'pre'):
-                for word in re.findall('([a-zA-Z]+\'?[a-zA-Z]+)', section.text):
-                    if not speller.check(word):
-                        if options['learn']:
-                            speller.addtoPersonal(word)
-                        else:
-                            result = False
-                            print('[-] Misspelled (unknown) word {0} in {1}'.
-                                  format(word.encode('utf-8'), filename))
-        if options['learn']:
-            speller.saveAllwords()
+               section.tag not in NOT_SPELLED:
+                result = check_spelling(section.text, filename, options,
+                                        section.sourceline) and result
     except aspell.AspellSpellerError as exception:
         print('[-] Spelling disabled ({0})'.format(exception))
     return result
 
 
+def save_spelling(options):
+    """
+    Saves learned words to the dictionary, and known good words to the
+    spelling cache.
+    """
+    try:
+        if options['learn'] and SPELLER is not None:
+            SPELLER.saveAllwords()
+    except aspell.AspellSpellerError as exception:
+        print('[-] Could not save vocabulary ({0})'.format(exception))
+    write_spelling_cache(options)
+
+
 def all_files():
     """
     Returns a list of all files contained in the git repository.
     """
-    cmd = ['git', 'ls-files']
+    return git_output(['git', 'ls-files'])
+
+
+def changed_files(options):
+    """
+    Returns a list of all existing files that are staged (options['staged']),
+    or that changed since revision options['changed_since'], including files
+    that aren't tracked yet.
+    """
+    if options['staged']:
+        filenames = git_output(['git', 'diff', '--cached', '--name-only',
+                                '--relative'])
+    else:
+        filenames = git_output(['git', 'diff', '--name-only', '--relative',
+                                options['changed_since']]) + \
+            git_output(['git', 'ls-files', '--others', '--exclude-standard'])
+    return [filename for filename in filenames if os.path.isfile(filename)]
+
+
+class GitError(IOError):
+    """
+    Raised when a git command fails.
+    """
+    pass
+
+
+def git_output(cmd):
+    """
+    Returns the lines of the output of git command @cmd.
+    Raises GitError, with the error of git, when the command fails.
+    """
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE)
+    stdout, stderr = process.communicate()
+    if process.returncode:
+        raise GitError('{0} failed: {1}'.format(
+            ' '.join(cmd), stderr.decode('utf-8', 'replace').strip()))
+    return stdout.decode('utf-8').splitlines()
+
+
+def git_file(filename):
+    """
+    Returns the path of @filename within the git directory. The git directory
+    is only looked up once.
+    """
+    cwd = os.getcwd()
+    if cwd not in GIT_DIRS:
+        git_dir = git_output(['git', 'rev-parse', '--git-dir'])
+        GIT_DIRS[cwd] = os.path.abspath(git_dir[0] if git_dir else '.')
+    return os.path.join(GIT_DIRS[cwd], filename)
+
+
+@contextlib.contextmanager
+def open_source(filename, staged=False):
+    """
+    Opens @filename for reading in binary mode, or the version of @filename
+    that is staged for commit when @staged.
+    """
+    if not staged:
+        with open(filename, 'rb') as source:
+            yield source
+        return
+    cmd = ['git', 'cat-file', 'blob', ':./' + filename]
     process = subprocess.Popen(cmd, stdout=subprocess.PIPE,
                                stderr=subprocess.PIPE)
-    return process.stdout.read().splitlines()
+    try:
+        yield process.stdout
+    finally:
+        process.stdout.close()
+        stderr = process.stderr.read()
+        process.stderr.close()
+        process.wait()
+    # A negative return code means that git was stopped as the file wasn't
+    # read completely
+    if process.returncode > 0:
+        raise GitError('{0} failed: {1}'.format(
+            ' '.join(cmd), stderr.decode('utf-8', 'replace').strip()))
+
+
+def source_size(filename, staged=False):
+    """
+    Returns the size of @filename, or of its staged version when @staged.
+    """
+    if not staged:
+        return os.path.getsize(filename)
+    size = git_output(['git', 'cat-file', '-s', ':./' + filename])
+    if not size:
+        raise IOError('{0} is not staged'.format(filename))
+    return int(size[0])
+
+
+def read_cache(options):
+    """
+    Returns the validation cache: the git blob id and type of each file that
+    validated successfully with the current options.
+    """
+    if options['no_cache']:
+        return {}
+    try:
+        with open(git_file(CACHE_FILE)) as json_file:
+            cache = json.load(json_file)
+    except (IOError, ValueError):
+        return {}
+    if cache.get('key') != cache_key(options):
+        return {}
+    return cache.get('files', {})
+
+
+def write_cache(options, files):
+    """
+    Writes the validation cache with validated @files.
+    """
+    if options['no_cache']:
+        return
+    try:
+        with open(git_file(CACHE_FILE), 'w') as json_file:
+            json.dump({'key': cache_key(options), 'files': files}, json_file)
+    except IOError as exception:
+        print_output(options, 'Could not write validation cache ({0})'.
+                     format(exception))
+
+
+def cache_key(options):
+    """
+    Returns a key over the validator version and all options (and vocabulary)
+    that influence the validation result of a file.
+    """
+    key = [VALIDATOR_VERSION] + [options[option] for option in CACHED_OPTIONS]
+    if options['spelling'] and os.path.isfile(VOCABULARY):
+        key.append(blob_id(VOCABULARY))
+    return hashlib.sha1(json.dumps(key).encode('utf-8')).hexdigest()
+
+
+def blob_id(filename, staged=False):
+    """
+    Returns the git blob id of @filename, without invoking git, or the id of
+    its staged version when @staged.
+    """
+    if staged:
+        blob = git_output(['git', 'rev-parse', ':./' + filename])
+        if not blob:
+            raise IOError('{0} is not staged'.format(filename))
+        return blob[0]
+    digest = hashlib.sha1('blob {0}\0'.format(os.path.getsize(filename)).
+                          encode('utf-8'))
+    with open(filename, 'rb') as blob:
+        for chunk in iter(lambda: blob.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
 
 
 def open_editor(filename):
@@ -159,27 +500,142 @@ def validate_files(filenames, options):
     result = True
     masters = []
     externals = []
+    xml_files = []
     for filename in filenames:
         if (filename.lower().endswith('.xml') or
                 filename.lower().endswith('xml"')):
             if SNIPPETDIR not in filename:
-                if (OFFERTE in filename and options['offer']) or \
-                   (REPORT in filename and not options['no_report'] and \
-                    not TEMPLATEDIR in filename):
+                if is_master(filename, options):
                     masters.append(filename)
-                # try:
-                type_result, xml_type = validate_xml(filename, options)
-                result = result and type_result
-                if xml_type in ('scan', 'finding', 'non-finding'):
-                    externals.append(filename)
-#                except:
-#                    result = False
+                xml_files.append(filename)
+    cache = read_cache(options)
+    validated = {}
+    blobs = {}
+    types = {}
+    includes = {}  # XIncluded files of each file, for the cross checks
+    # Blob ids are only needed for the cache
+    hashed = [] if options['no_cache'] else xml_files
+    for filename in hashed:
+        try:
+            blobs[filename] = blob_id(filename, options['staged'])
+        except IOError:
+            continue
+        if cache.get(filename, {}).get('blob') == blobs[filename]:
+            print_output(options, 'Unchanged since last validation: {0}'.
+                         format(filename))
+            validated[filename] = cache[filename]
+            types[filename] = cache[filename]['type']
+            if cache[filename].get('includes') is not None:
+                includes[normalize(filename)] = cache[filename]['includes']
+    unvalidated = [filename for filename in xml_files if filename not in types]
+    for filename, (type_result, xml_type, file_includes) in zip(
+            unvalidated, validate_all(unvalidated, options)):
+        result = result and type_result
+        types[filename] = xml_type
+        if file_includes is not None:
+            includes[normalize(filename)] = file_includes
+        if type_result and filename in blobs:
+            validated[filename] = {'blob': blobs[filename], 'type': xml_type,
+                                   'includes': file_includes}
+    write_cache(options, dict(cache, **validated))
+    for filename in xml_files:
+        if types[filename] in ('scan', 'finding', 'non-finding'):
+            externals.append(filename)
     if len(masters):
         for master in masters:
-            result = validate_master(master, externals, options) and result
+            result = validate_master(master, externals, options,
+                                     includes) and result
     return result
 
 
+def is_master(filename, options):
+    """
+    Returns True if @filename is a master file that needs to be validated.
+    """
+    return (OFFERTE in filename and options['offer']) or \
+        (REPORT in filename and not options['no_report'] and
+         TEMPLATEDIR not in filename)
+
+
+def validate_all(filenames, options):
+    """
+    Validates all @filenames, using options['jobs'] parallel processes.
+    Output is shown in the order of @filenames.
+    Returns a list of (result, xml_type, includes) tuples in the same order.
+    """
+    # Editors are opened interactively, which needs one file at a time, and
+    # only one process can add words to the vocabulary
+    if options['jobs'] < 2 or options['edit'] or options['learn'] or \
+       len(filenames) < 2:
+        return [validate_xml(filename, options) for filename in filenames]
+    results = []
+    pool = multiprocessing.Pool(min(options['jobs'], len(filenames)))
+    try:
+        for result, xml_type, includes, output, words, issues, timings in \
+                pool.imap(validate_worker, [(filename, options)
+                                            for filename in filenames]):
+            sys.stdout.write(output)
+            results.append((result, xml_type, includes))
+            WORDS.update(dict.fromkeys(words, True))
+            NEW_WORDS.update(words)
+            ISSUES.extend(issues)
+            TIMINGS.update(timings)
+    finally:
+        pool.close()
+        pool.join()
+    return results
+
+
+def validate_worker(arguments):
+    """
+    Validates one file within a worker process, capturing its output.
+    Returns the result, the type, the includes and the output of
+    validate_xml, the correctly spelled words that were newly found, and the issues and timings
+    of the file.
+    """
+    filename, options = arguments
+    stdout = sys.stdout
+    sys.stdout = StringIO()
+    try:
+        result, xml_type, includes = validate_xml(filename, options)
+        words = list(NEW_WORDS)
+        NEW_WORDS.clear()
+        issues = list(ISSUES)
+        del ISSUES[:]
+        timings = dict(TIMINGS)
+        TIMINGS.clear()
+        return result, xml_type, includes, sys.stdout.getvalue(), words, \
+            issues, timings
+    finally:
+        sys.stdout = stdout
+
+
+def report_issue(filename, rule, message, severity='error', line=None,
+                 fixable=False):
+    """
+    Shows @message, and records the issue for machine-readable output.
+    """
+    print(message)
+    ISSUES.append({'file': filename, 'line': line, 'rule': rule,
+                   'message': message[4:] if message[:4] in ('[-] ', '[A] ')
+                   else message,
+                   'severity': severity, 'fixable': fixable})
+
+
+@contextlib.contextmanager
+def timed(filename, check):
+    """
+    Adds the seconds spent in the with block to the timings of @check for
+    @filename.
+    """
+    start = time.time()
+    try:
+        yield
+    finally:
+        checks = TIMINGS.setdefault(filename, {})
+        checks[check] = checks.get(check, 0) + time.time() - start
+
+
 def print_output(options, stdout, stderr=None):
     """
     Prints out standard out and standard err using the verboseprint function.
@@ -200,41 +656,202 @@ def validate_report():
     return proxy_vagrant.execute_command(host, command)
 
 
+def parse_xml(filename, cache=False, staged=False):
+    """
+    Returns the parsed XML tree of @filename, or of its staged version when
+    @staged. When @cache is True, the tree is kept, and subsequent calls
+    return the same tree. Only master files are cached, so that the trees of
+    all other files can be freed after use.
+    Raises ElementTree.ParseError or IOError when parsing failed.
+    """
+    if filename in PARSED:
+        return PARSED[filename]
+    with open_source(filename, staged) as source:
+        tree = ElementTree.parse(source,
+                                 ElementTree.XMLParser(strip_cdata=False))
+    if cache:
+        PARSED[filename] = tree
+    return tree
+
+
 def validate_xml(filename, options):
     """
     Validates XML file by trying to parse it.
-    Returns True if the file validated successfully.
+    Returns True if the file validated successfully, the type of the file,
+    and the files it XIncludes (None when the file wasn't parsed).
     """
     result = True
     xml_type = ''
+    includes = None
     print_output(options, 'Validating XML file: {0}'.format(filename))
+    TEXTS.clear()
     try:
-        with open(filename, 'rb') as xml_file:
-            xml.sax.parse(xml_file, xml.sax.ContentHandler())
-        tree = ElementTree.parse(filename, ElementTree.XMLParser(strip_cdata=False))
+        if source_size(filename, options['staged']) > STREAM_SIZE:
+            with timed(filename, 'stream'):
+                result, xml_type = validate_stream(filename, options)
+            if xml_type not in TYPED:
+                if options['edit'] and not result:
+                    open_editor(filename)
+                return result, xml_type, includes
+            result = True
+        with timed(filename, 'parse'):
+            tree = parse_xml(filename, staged=options['staged'])
+        includes = xincludes(tree, filename)
         type_result, xml_type = validate_type(tree, filename, options)
-        result = validate_long_lines(tree, filename, options) and result and type_result
+        with timed(filename, 'long'):
+            result = validate_long_lines(tree, filename, options) and result and type_result
+        if EXAMPLEDIR not in filename and TEMPLATEDIR not in filename:
+            with timed(filename, 'keyword'):
+                keyword_result = find_keywords(tree, filename, options)
+            if not keyword_result:
+                print('[-] Keyword checks failed for {0}'.format(filename))
+                result = False
         if options['edit'] and not result:
             open_editor(filename)
-    except (xml.sax.SAXException, ElementTree.ParseError) as exception:
-        print('[-] validating {0} failed ({1})'.format(filename, exception))
+    except ElementTree.ParseError as exception:
+        report_issue(filename, 'xml', '[-] validating {0} failed ({1})'.
+                     format(filename, exception),
+                     line=getattr(exception, 'lineno', None))
         result = False
-    except IOError as exception:
-        print('[-] validating {0} failed ({1})'.format(filename, exception))
+    except (IOError, OSError) as exception:
+        report_issue(filename, 'xml', '[-] validating {0} failed ({1})'.
+                     format(filename, exception))
+        result = False
+    return result, xml_type, includes
+
+
+def validate_stream(filename, options):
+    """
+    Validates a large XML file element by element, discarding elements once
+    they have been checked, so that memory usage stays bounded.
+    Stops at the root element for types that need the complete tree.
+    Returns the result and the type of the file.
+    """
+    result = True
+    xml_type = ''
+    print_output(options, 'Streaming large XML file: {0}'.format(filename))
+    keywords = EXAMPLEDIR not in filename and TEMPLATEDIR not in filename
+    pattern = keyword_pattern(options)
+    keyword_result = True
+    spelling = options['spelling']
+    sections = ['']  # labels of the sections that are open
+    # Texts with their section, of which the line is only known once the
+    # next element starts
+    pending = []
+    with open_source(filename, options['staged']) as source:
+        source = LineReader(source)
+        for event, element in ElementTree.iterparse(source,
+                                                    events=('start', 'end'),
+                                                    strip_cdata=False,
+                                                    huge_tree=True):
+            if event == 'start':
+                if not xml_type:
+                    xml_type = element.tag
+                    if xml_type in TYPED:
+                        return result, xml_type
+                    if element.get('id'):
+                        sections[0] = ' in {0}'.format(element.get('id'))
+                # The text before this element is complete, and ends here
+                previous = element.getprevious()
+                if previous is not None and previous.tail:
+                    pending.append((previous.tail, sections[-1]))
+                if keywords and not check_pending(pending, element.sourceline,
+                                                  filename, pattern):
+                    keyword_result = False
+                del pending[:]
+                if element.tag == 'section' and 'id' in element.attrib:
+                    sections.append(' in section {0}'.
+                                    format(element.attrib['id']))
+                else:
+                    sections.append(sections[-1])
+                continue
+            if keywords and element.text and \
+               not check_keywords(element.text, element.sourceline, filename,
+                                  sections[-1], pattern):
+                keyword_result = False
+            if len(element) and element[-1].tail:
+                pending.append((element[-1].tail, sections[-1]))
+            sections.pop()
+            if options['long'] and element.tag == 'pre':
+                pre_result, fix, fixed_text = check_pre(element, filename)
+                result = pre_result and result
+                if fix:
+                    print(fixed_text)
+            if spelling and element.text and \
+               isinstance(element.tag, basestring) and \
+               element.tag not in NOT_SPELLED:
+                try:
+                    result = check_spelling(element.text, filename, options,
+                                            element.sourceline) and result
+                except aspell.AspellSpellerError as exception:
+                    print('[-] Spelling disabled ({0})'.format(exception))
+                    spelling = False
+            element.clear(keep_tail=True)
+            while element.getprevious() is not None:
+                del element.getparent()[0]
+    # Texts before the end tag of the root element
+    if keywords and not check_pending(pending, source.last_line(), filename,
+                                      pattern):
+        keyword_result = False
+    if not keyword_result:
+        print('[-] Keyword checks failed for {0}'.format(filename))
         result = False
     return result, xml_type
 
 
+class LineReader(object):
+    """
+    Reads a file object, and keeps track of the number of lines read.
+    """
+    def __init__(self, source):
+        self.source = source
+        self.lines = 1
+        self.trailing = 0  # newlines after the last tag
+
+    def read(self, size=-1):
+        """
+        Returns at most @size bytes of the file.
+        """
+        data = self.source.read(size)
+        self.lines += data.count(b'\n')
+        end = data.rfind(b'>')
+        if end < 0:
+            self.trailing += data.count(b'\n')
+        else:
+            self.trailing = data.count(b'\n', end)
+        return data
+
+    def last_line(self):
+        """
+        Returns the line of the last tag that was read.
+        """
+        return self.lines - self.trailing
+
+
+def check_pending(pending, end, filename, pattern):
+    """
+    Finds keywords in the consecutive (text, section) tuples of @pending,
+    which end on line @end, separated by end tags.
+    Returns True if no keywords were found.
+    """
+    result = True
+    lines = []
+    for text, _section in reversed(pending):
+        end -= text.count('\n')
+        lines.insert(0, end)
+    for (text, section), line in zip(pending, lines):
+        result = check_keywords(text, line, filename, section,
+                                pattern) and result
+    return result
+
+
 def get_all_text(node):
     """
-    Retrieves all text within tags.
+    Retrieves all text within tags, memoized per element.
     """
-    text_string = node.text or ''
-    for element in node:
-        text_string += get_all_text(element)
-    if node.tail:
-        text_string += node.tail
-    return text_string.strip()
+    if node not in TEXTS:
+        TEXTS[node] = (''.join(node.itertext()) + (node.tail or '')).strip()
+    return TEXTS[node]
 
 
 def is_capitalized(line):
@@ -259,79 +876,144 @@ def capitalize(line):
     return capitalized.strip()
 
 
+def get_schema():
+    """
+    Returns the compiled schema validator of this process. The compiled
+    validator is cached in the git directory, so that the schema only has to
+    be compiled once.
+    """
+    global SCHEMA_VALIDATOR
+    if SCHEMA_VALIDATOR is None:
+        key = hashlib.sha1(json.dumps([SCHEMA, ElementTree.LXML_VERSION]).
+                           encode('utf-8')).hexdigest()
+        cache = git_file(SCHEMA_CACHE.format(key[:12]))
+        try:
+            SCHEMA_VALIDATOR = ElementTree.XSLT(ElementTree.parse(cache))
+        except (IOError, ElementTree.XMLSyntaxError,
+                ElementTree.XSLTParseError):
+            schema = isoschematron.Schematron(
+                ElementTree.fromstring(SCHEMA.encode('utf-8')),
+                store_xslt=True)
+            try:
+                # Parallel jobs may compile the schema at the same time, so
+                # write to a temporary file and move it in place at once
+                handle, temporary = tempfile.mkstemp(
+                    dir=os.path.dirname(cache), suffix='.tmp')
+                with os.fdopen(handle, 'wb') as xslt_file:
+                    schema.validator_xslt.write(xslt_file)
+                getattr(os, 'replace', os.rename)(temporary, cache)
+            except (IOError, OSError) as exception:
+                print('[-] Could not cache compiled schema ({0})'.
+                      format(exception))
+            SCHEMA_VALIDATOR = ElementTree.XSLT(schema.validator_xslt)
+    return SCHEMA_VALIDATOR
+
+
+def validate_schema(tree, filename):
+    """
+    Validates @tree against the rules of all document types in one pass.
+    Returns True if no rule with role error failed.
+    """
+    result = True
+    report = get_schema()(tree)
+    for failed in report.getroot().iter(SVRL + 'failed-assert'):
+        message = ' '.join(failed.findtext(SVRL + 'text', '').split())
+        try:
+            line = tree.xpath(failed.get('location'))[0].sourceline
+        except (ElementTree.XPathError, IndexError, TypeError, AttributeError):
+            line = None
+        report_issue(filename, failed.get('id'),
+                     message.replace('{filename}', filename),
+                     severity=failed.get('role'), line=line)
+        if failed.get('role') == 'error':
+            result = False
+    return result
+
+
+def validate_fixable(tree, filename, options):
+    """
+    Performs the checks of specific types that can be fixed automatically.
+    Returns a list of fixes as (path, attribute, value), where an attribute of
+    None stands for the text of the element at path.
+    """
+    fixes = []
+    root = tree.getroot()
+    xml_type = root.tag
+    if xml_type in ('finding', 'non-finding') and 'id' not in root.attrib:
+        report_issue(filename, 'missing-id',
+                     '[A] Missing obligatory attribute in {0}: {1}'.
+                     format(filename, 'id'), line=root.sourceline,
+                     fixable=True)
+        fixes.append(('.', 'id', filename))
+    if xml_type == 'finding' and 'type' in root.attrib and \
+       options['capitalization'] and not is_capitalized(root.attrib['type']):
+        report_issue(filename, 'type-capitalization',
+                     '[A] Type missing capitalization (expected {0}, read {1})'.
+                     format(capitalize(root.attrib['type']),
+                            root.attrib['type']),
+                     line=root.sourceline, fixable=True)
+        fixes.append(('.', 'type', capitalize(root.attrib['type'])))
+    title = root.find('title')
+    if xml_type != 'pentest_report' and title is not None and \
+       get_all_text(title) and options['capitalization'] and \
+       not is_capitalized(title.text):
+        report_issue(filename, 'title-capitalization',
+                     '[A] Title missing capitalization in {0} (expected {1}, read {2})'.
+                     format(filename, capitalize(title.text), title.text),
+                     line=title.sourceline, fixable=True)
+        fixes.append(('title', None, capitalize(title.text)))
+    description = root.find('description')
+    if xml_type == 'finding' and description is not None:
+        text = get_all_text(description)
+        if text and text[-1] != '.':
+            report_issue(filename, 'final-dot',
+                         '[A] Description missing final dot in {0}: {1}'.
+                         format(filename, text),
+                         line=description.sourceline, fixable=True)
+            fixes.append(('description', None, text + '.'))
+    return fixes
+
+
+def apply_fixes(tree, fixes):
+    """
+    Applies @fixes, as returned by validate_fixable, to @tree.
+    """
+    root = tree.getroot()
+    for path, attribute, value in fixes:
+        element = root if path == '.' else root.find(path)
+        if attribute:
+            element.set(attribute, value)
+        else:
+            element.text = value
+
+
 def validate_type(tree, filename, options):
     """
-    Performs specific checks based on type.
-    Currently only Finding and Non-Finding are supported.
+    Performs specific checks based on type: the rules of the schema, and the
+    checks that can be fixed automatically. Fixes are made on a copy, so that
+    @tree itself is left as it was parsed.
     """
     result = True
-    fix = False
     root = tree.getroot()
     xml_type = root.tag
-    attributes = []
-    tags = []
     if options['spelling']:
-        result = validate_spelling(tree, filename, options)
-    if xml_type == 'pentest_report':
-        attributes = ['findingCode']
-    if xml_type == 'finding':
-        attributes = ['threatLevel', 'type', 'id']
-        tags = ['title', 'description', 'technicaldescription', 'impact',
-                'recommendation']
-    if xml_type == 'non-finding':
-        attributes = ['id']
-        tags = ['title']
-    if not len(attributes):
+        with timed(filename, 'spelling'):
+            result = validate_spelling(tree, filename, options)
+    if xml_type not in TYPED:
         return result, xml_type
-
-    for attribute in attributes:
-        if attribute not in root.attrib:
-            print('[A] Missing obligatory attribute in {0}: {1}'.
-                  format(filename, attribute))
-            if attribute == 'id':
-                root.set(attribute, filename)
-                fix = True
-            else:
-                result = False
-        else:
-            if attribute == 'threatLevel' and root.attrib[attribute] not in \
-               ('Low', 'Moderate', 'Elevated', 'High', 'Extreme'):
-                print('[-] threatLevel is not Low, Moderate, High, Elevated or Extreme: {0}'.format(root.attrib[attribute]))
-                result = False
-            if attribute == 'type' and (options['capitalization'] and not \
-                                        is_capitalized(root.attrib[attribute])):
-                print('[A] Type missing capitalization (expected {0}, read {1})'.
-                      format(capitalize(root.attrib[attribute]),
-                             root.attrib[attribute]))
-                root.attrib[attribute] = capitalize(root.attrib[attribute])
-                fix = True
-    for tag in tags:
-        if root.find(tag) is None:
-            print('[-] Missing tag in {0}: {1}'.format(filename, tag))
-            result = False
-            continue
-        if not get_all_text(root.find(tag)):
-            print('[-] Empty tag in {0}: {1}'.format(filename, tag))
-            result = False
-            continue
-        if tag == 'title' and (options['capitalization'] and \
-                               not is_capitalized(root.find(tag).text)):
-            print('[A] Title missing capitalization in {0} (expected {1}, read {2})'.
-                  format(filename, capitalize(root.find(tag).text),
-                         root.find(tag).text))
-            root.find(tag).text = capitalize(root.find(tag).text)
-            fix = True
-        if tag == 'description' and get_all_text(root.find(tag)).strip()[-1] != '.':
-            print('[A] Description missing final dot in {0}: {1}'.format(filename, get_all_text(root.find(tag))))
-            root.find(tag).text = get_all_text(root.find(tag)).strip() + '.'
-            fix = True
-    if fix:
+    with timed(filename, 'schema'):
+        result = validate_schema(tree, filename) and result
+    with timed(filename, 'type'):
+        fixes = validate_fixable(tree, filename, options)
+    if fixes:
         if options['auto_fix']:
             print('[+] Automatically fixed {0}'.format(filename))
-            tree.write(filename)
+            fixed_tree = copy.deepcopy(tree)
+            apply_fixes(fixed_tree, fixes)
+            fixed_tree.write(filename)
         else:
             print('[+] NOTE: Items with [A] can be fixed automatically, use --auto-fix')
-    return (result and not fix), xml_type
+    return (result and not fixes), xml_type
 
 
 def validate_long_lines(tree, filename, options):
@@ -346,22 +1028,9 @@ def validate_long_lines(tree, filename, options):
     root = tree.getroot()
     for pre_section in root.iter('pre'):
         if pre_section.text:
-            fixed_text = ''
-            for line in pre_section.text.splitlines():
-                fixed_line = line
-                if len(line.strip()) > MAX_LINE:
-                    if ' ' not in line[WARN_LINE:MAX_LINE]:
-                        print('[-] {0} Line inside <pre> too long: {1}'.
-                              format(filename, line.encode('utf-8')[WARN_LINE:]))
-                        result = False
-                        for split in ['"', '\'', '=', '-', ';']:
-                            if split in line.encode('utf-8').strip()[WARN_LINE:MAX_LINE]:
-                                print('[A] can be fixed')
-                                fix = True
-                                index = line.find(split, WARN_LINE)
-                                fixed_line = line[:index + 1] + '\n'
-                                fixed_line += line[index + 1:]
-                fixed_text += fixed_line.encode('utf-8')
+            pre_result, pre_fix, fixed_text = check_pre(pre_section, filename)
+            result = result and pre_result
+            fix = fix or pre_fix
     if fix:
         if options['auto_fix']:
             print('[+] Automatically fixed {0}'.format(filename))
@@ -370,81 +1039,292 @@ def validate_long_lines(tree, filename, options):
     return result
 
 
-def validate_master(filename, externals, options):
+def check_pre(pre_section, filename):
+    """
+    Checks whether <pre> element @pre_section contains lines longer than
+    MAX_LINE characters.
+    Returns the result, whether the lines can be fixed, and the fixed text.
+    """
+    result = True
+    fix = False
+    fixed_text = ''
+    for number, line in enumerate((pre_section.text or '').splitlines()):
+        fixed_line = line
+        if len(line.strip()) > MAX_LINE:
+            if ' ' not in line[WARN_LINE:MAX_LINE]:
+                splits = [split for split in ['"', '\'', '=', '-', ';']
+                          if split in line.strip()[WARN_LINE:MAX_LINE]]
+                report_issue(filename, 'long-line',
+                             '[-] {0} Line inside <pre> too long: {1}'.
+                             format(filename, line[WARN_LINE:]),
+                             line=(pre_section.sourceline or 0) + number,
+                             fixable=bool(splits))
+                result = False
+                for split in splits:
+                    print('[A] can be fixed')
+                    fix = True
+                    index = line.find(split, WARN_LINE)
+                    fixed_line = line[:index + 1] + '\n'
+                    fixed_line += line[index + 1:]
+        fixed_text += fixed_line + '\n'
+    return result, fix, fixed_text
+
+
+def validate_master(filename, externals, options, includes=None):
     """
-    Validates master file.
+    Validates master file. @includes are the XIncluded files of each file
+    that was validated already, so that those files aren't parsed again.
     """
     result = True
+    includes = includes or {}
     print_output(options, '[*] Validating master file {0}'.format(filename))
     try:
-        xmltree = ElementTree.parse(filename,
-                                    ElementTree.XMLParser(strip_cdata=False))
-        if not find_keyword(xmltree, 'TODO', filename):
-            print('[-] Keyword checks failed for {0}'.format(filename))
-            result = False
+        if normalize(filename) not in includes:
+            parse_xml(filename, True, options['staged'])
         print_output(options, 'Performing cross check on scans, findings and non findings...')
-        if not cross_check_files(filename, externals):
+        with timed(filename, 'cross-check'):
+            cross_result = cross_check_files(filename, externals,
+                                             options['staged'], includes)
+        if not cross_result:
             print('[-] Cross checks failed for {0}'.format(filename))
             result = False
         else:
             print_output(options, '[+] Cross checks successful')
     except (ElementTree.ParseError, IOError) as exception:
-        print('[-] validating {0} failed ({1})'.format(filename, exception))
+        report_issue(filename, 'xml', '[-] validating {0} failed ({1})'.
+                     format(filename, exception))
         result = False
     return result
 
 
-def report_string(report_file):
+def normalize(filename):
     """
-    Return the report_file into a big memory mapped string.
+    Returns @filename relative to the current directory, with forward
+    slashes, as used for the XIncludes of files.
     """
-    try:
-        report = open(report_file)
-        return mmap.mmap(report.fileno(), 0, access=mmap.ACCESS_READ)
-    except IOError as exception:
-        print('[-] Could not open {0} ({1})'.format(report_file, exception))
-        sys.exit(-1)
+    return os.path.normpath(filename).replace(os.sep, '/')
+
+
+def xincludes(tree, filename):
+    """
+    Returns the local files that are XIncluded by @tree of @filename, as
+    [filename, parse] lists.
+    """
+    includes = []
+    for include in tree.iter(XINCLUDE):
+        href = (include.get('href') or '').split('#')[0]
+        if not href or '://' in href:
+            continue
+        includes.append([normalize(os.path.join(os.path.dirname(filename),
+                                                href)),
+                         include.get('parse', 'xml')])
+    return includes
+
+
+def reference_index(filename, index=None, staged=False, includes=None):
+    """
+    Returns a dictionary with all files that are XIncluded by @filename, and
+    by the files that those include (recursively), mapped to the file that
+    includes them. Filenames are relative to the current directory.
+    Files are only parsed when their XIncludes aren't in @includes already.
+    When @staged, the staged versions of the files are read.
+    """
+    if index is None:
+        index = {}
+    if includes is None:
+        includes = {}
+    if normalize(filename) not in includes:
+        try:
+            includes[normalize(filename)] = xincludes(
+                parse_xml(filename, staged=staged), filename)
+        except (ElementTree.ParseError, IOError):
+            return index  # reported when validating the file itself
+    for reference, parse in includes[normalize(filename)]:
+        if reference in index:
+            continue
+        index[reference] = filename
+        if parse == 'xml' and (reference in includes or
+                               (os.path.isfile(reference) and
+                                os.path.getsize(reference) <= STREAM_SIZE)):
+            reference_index(reference, index, staged, includes)
+    return index
 
 
-def cross_check_files(filename, externals):
+def cross_check_files(filename, externals, staged=False, includes=None):
     """
-    Checks whether all (non) findings are included in the report file.
+    Checks whether all (non) findings are included in the report file, and
+    whether all files included by the report file exist.
+    When @staged, the staged versions of the files are checked. @includes
+    are the already known XIncludes of files.
     Returns True if the checks were successful.
     """
     result = True
-    report_text = report_string(filename)
+    index = reference_index(filename, staged=staged, includes=includes)
     for external in externals:
         if (EXAMPLEDIR not in external) and (SNIPPETDIR not in external) and \
            (TEMPLATEDIR not in external):
-            if report_text.find(external) == -1:
-                    print('[-] could not find a reference in {0} to {1}'.format(filename, external))
-                    result = False
+            if os.path.normpath(external).replace(os.sep, '/') not in index:
+                report_issue(external, 'unreferenced',
+                             '[-] could not find a reference in {0} to {1}'.
+                             format(filename, external))
+                result = False
+    for reference in sorted(index):
+        if not os.path.isfile(reference):
+            report_issue(index[reference], 'missing-reference',
+                         '[-] {0} references missing file {1}'.
+                         format(index[reference], reference))
+            result = False
     return result
 
 
-def find_keyword(xmltree, keyword, filename):
+def keyword_pattern(options):
     """
-    Finds keywords in an XML tree.
-    This function needs lots of TLC.
+    Returns one compiled regular expression that matches all KEYWORDS and
+    options['keyword'].
+    """
+    keywords = tuple(KEYWORDS + options['keyword'])
+    if keywords not in KEYWORD_PATTERNS:
+        KEYWORD_PATTERNS[keywords] = re.compile('|'.join(
+            '(?:{0})'.format(keyword) for keyword in keywords))
+    return KEYWORD_PATTERNS[keywords]
+
+
+def find_keywords(xmltree, filename, options):
+    """
+    Finds keywords in all text of an XML tree, in one pass.
+    Returns True if no keywords were found.
     """
     result = True
-    section = ''
+    pattern = keyword_pattern(options)
+    root = xmltree.getroot()
+    sections = {None: ''}  # label of the section each element is in
+    if root.get('id'):  # e.g. the id of a finding
+        sections[None] = ' in {0}'.format(root.get('id'))
     for tag in xmltree.iter():
-        if tag.tag == 'section' and' id' in tag.attrib:
-            section = 'in {0}'.format(tag.attrib['id'])
+        outer = sections[tag.getparent()]
+        section = outer
+        if tag.tag == 'section' and 'id' in tag.attrib:
+            section = ' in section {0}'.format(tag.attrib['id'])
+        sections[tag] = section
         if tag.text:
-            if keyword in tag.text:
-                print('[-] {0} found in {1} {2}'.format(keyword, filename, section))
-                result = False
+            result = check_keywords(tag.text, tag.sourceline, filename,
+                                    section, pattern) and result
+        # Only look up where the tail starts when it contains keywords
+        if tag.tail and pattern.search(tag.tail):
+            result = check_keywords(tag.tail, tail_line(tag), filename,
+                                    outer, pattern) and result
     return result
 
 
+def tail_line(element):
+    """
+    Returns the line on which the tail of @element starts: the line where
+    the next element starts, or where the parent ends, minus the lines within
+    the tail itself.
+    """
+    following = element.getnext()
+    if following is not None and following.sourceline:
+        end = following.sourceline
+    elif element.getparent() is not None:
+        end = tail_line(element.getparent())  # the end tag of the parent
+    else:  # the end tag of the root element
+        return (element.sourceline or 0) + ElementTree.tostring(
+            element, with_tail=False).count(b'\n')
+    return end - (element.tail or '').count('\n')
+
+
+def check_keywords(text, line, filename, section, pattern):
+    """
+    Finds keywords matching @pattern in @text, which starts on @line.
+    Returns True if no keywords were found.
+    """
+    result = True
+    for match in pattern.finditer(text):
+        number = (line or 0) + text.count('\n', 0, match.start())
+        report_issue(filename, 'keyword', '[-] {0} found in {1} on line {2}{3}'.
+                     format(match.group(), filename, number, section),
+                     line=number)
+        result = False
+    return result
+
+
+def json_report(result):
+    """
+    Returns the issues and timings as JSON.
+    """
+    return json.dumps({'result': result, 'issues': ISSUES,
+                       'timings': TIMINGS}, indent=2, sort_keys=True)
+
+
+def junit_report(result):
+    """
+    Returns the issues and timings as JUnit XML, with one test case per file.
+    """
+    filenames = sorted(set(TIMINGS) | set(issue['file'] for issue in ISSUES))
+    suite = ElementTree.Element('testsuite', name='validate_report',
+                                tests=str(len(filenames)))
+    failures = 0
+    for filename in filenames:
+        testcase = ElementTree.SubElement(
+            suite, 'testcase', classname='validate_report', name=filename,
+            time='{0:.3f}'.format(sum(TIMINGS.get(filename, {}).values())))
+        issues = [issue for issue in ISSUES if issue['file'] == filename]
+        if issues:
+            failures += 1
+            failure = ElementTree.SubElement(
+                testcase, 'failure', type=issues[0]['rule'],
+                message='{0} issue(s)'.format(len(issues)))
+            failure.text = '\n'.join('{0}:{1}: [{2}] {3}'.format(
+                filename, issue['line'] or 0, issue['rule'], issue['message'])
+                                     for issue in issues)
+        ElementTree.SubElement(testcase, 'system-out').text = \
+            json.dumps(TIMINGS.get(filename, {}), sort_keys=True)
+    suite.set('failures', str(failures))
+    if not result and not failures:
+        suite.set('errors', '1')
+    return ElementTree.tostring(suite, pretty_print=True,
+                                xml_declaration=True,
+                                encoding='UTF-8').decode('utf-8')
+
+
+def sarif_report(result):
+    """
+    Returns the issues and timings as SARIF. The run itself always succeeded,
+    failed checks are results with level error, and @result is the exit code.
+    """
+    results = []
+    for issue in ISSUES:
+        location = {'artifactLocation': {'uri': issue['file']}}
+        if issue['line']:
+            location['region'] = {'startLine': issue['line']}
+        results.append({'ruleId': issue['rule'],
+                        'level': issue['severity'] if issue['severity'] in
+                        SARIF_LEVELS else 'error',
+                        'message': {'text': issue['message']},
+                        'locations': [{'physicalLocation': location}],
+                        'properties': {'fixable': issue['fixable']}})
+    rules = sorted(set(issue['rule'] for issue in ISSUES))
+    return json.dumps({
+        '$schema': SARIF_SCHEMA, 'version': '2.1.0',
+        'runs': [{'tool': {'driver': {'name': 'validate_report',
+                                      'rules': [{'id': rule}
+                                                for rule in rules]}},
+                  'invocations': [{'executionSuccessful': True,
+                                   'exitCode': 0 if result else 1}],
+                  'results': results,
+                  'properties': {'timings': TIMINGS}}]},
+                      indent=2, sort_keys=True)
+
+
 def main():
     """
     The main program. Cross-checks, validates XML files and report.
-    Returns True if the checks were successful.
+    Returns the exit code: 0 if the checks were successful, 1 otherwise.
     """
     options = parse_arguments()
+    stdout = sys.stdout
+    if options['format'] != 'text':
+        sys.stdout = sys.stderr  # keep stdout for the machine-readable output
     if options['all']:
         options['capitalization'] = True
         options['long'] = True
@@ -455,8 +1335,26 @@ def main():
 #            print_output(options, 'Creating project-specific vocabulary file {0}'.
 #                  format(VOCABULARY))
 #            options['learn'] = True
-    print_output(options, 'Validating all XML files...')
-    result = validate_files(all_files(), options)
+    try:
+        filenames = all_files()
+        if options['staged'] or options['changed_since']:
+            changed = changed_files(options)
+    except GitError as exception:
+        print('[-] {0}'.format(exception), file=sys.stderr)
+        sys.stdout = stdout
+        return 1
+    if options['staged'] or options['changed_since']:
+        print_output(options, 'Validating changed XML files...')
+        # Changed masters need to be cross-checked against all files
+        if not any(is_master(filename, options) for filename in changed):
+            filenames = changed + [filename for filename in filenames if
+                                   is_master(filename, options) and
+                                   filename not in changed]
+    else:
+        print_output(options, 'Validating all XML files...')
+    result = validate_files(filenames, options)
+    if options['spelling']:
+        save_spelling(options)
     if result:
         print_output(options, 'Validation checks successful')
         if DOCBUILDER:
@@ -469,7 +1367,13 @@ def main():
     if options['spelling'] and options['learn']:
         print('[*] Don\'t forget to check the vocabulary file {0}'.
               format(VOCABULARY))
+    sys.stdout = stdout
+    if options['format'] != 'text':
+        reports = {'json': json_report, 'junit': junit_report,
+                   'sarif': sarif_report}
+        print(reports[options['format']](result))
+    return 0 if result else 1
 
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())